@@ -1,19 +1,24 @@
 import json
 import os
 import csv
+import copy
 from pathlib import Path
 from cmd import Cmd
-import concurrent.futures
+from collections import Counter
 from typing import Iterable, NoReturn
 
 import json2tab.utils as utils
-from json2tab.utils import parse, get_top_keys
-from json2tab.helpers import FileHandler, RowBuffer, open_file, Row
+from json2tab.utils import parse, get_top_keys, get_input_files, probe_file
+from json2tab.helpers import FileHandler, RowBuffer, RecordHashes, CSVEncoder, open_file, open_range, Row, \
+    SparseRow, concat_files, DuplicateIdentifierError, Progress, bytes_read, input_size
 from json2tab.config import Config
 from json2tab.mapping import Mapping
+from json2tab.filters import RecordFilter
+from json2tab.sinks import SQLiteHandler, AsyncSink, AsyncCSVSink
+from json2tab.shard import write_manifest, read_manifest, check_input, part_name, merge_parts
+from json2tab import mapfile
 
-from tqdm import tqdm
-import ijson
+# ijson, tqdm, concurrent.futures and sqlite3 are imported where they are used, so short commands start quickly
 import click
 
 
@@ -32,89 +37,171 @@ def json_bytes_from_file(f):
 def create_col_lookup(columns, size):
     return dict(zip(columns, range(size)))
 
-def flatten(files: FileHandler, select_tables: list, mappings: dict, writers: list, conf: Config) -> NoReturn:
+@utils.coroutine
+def assemble_rows(row_buffer: RowBuffer, select_tables: list, mappings: dict, conf: Config, counts: Counter,
+                  record_hashes: RecordHashes = None):
     """
-    Flatten json and output to csv
+    Coroutine receiving the events of `utils.parse_coro` and appending one row per table of mappings
+    to row_buffer for every top-level json
 
-    :param files: output files
+    :param row_buffer: buffer receiving the rows of every record
     :param select_tables: selected tables to output
     :param mappings: mapping dict specifying structure of output files
-    :param writers: list of output writers
-     :param conf: User specified configuration
+    :param conf: User specified configuration
+    :param counts: counter of the records parsed ("records"), the values written to overflow columns ("overflow")
+        and the records skipped by `conf.where` ("rejected")
+    :param record_hashes: if given, only output records that are new or changed since the previous run
     """
-    row_buffer = RowBuffer()
-
     id_dict = {}  # keep track of specified identifier values e.g. factId and rollNumber
     for identifier in conf.identifiers:
         id_dict[identifier] = None
 
     # current row being parsed for every table
     current_rows = {}
-    index_lookup = {}
     for table in mappings:
         num_cols = len(mappings[table])
 
         # list indices of corresponding columns
         col_lookup = create_col_lookup(mappings[table].keys(), num_cols)
-        index_lookup[table] = col_lookup
         current_rows[table] = Row(num_cols, col_lookup)
 
-    pbar = tqdm(total=Mapping.total_count_json, desc='Flattening JSON', unit=" lines")
-
-    @ijson.coroutine
-    def process(exe):
-        while True:
-            (base_prefix, prefix, event, value) = (yield)
-
-            if event == "string" or event == "number" or event == "boolean":
-                for id_key in id_dict:
-                    if id_dict[id_key] is None and base_prefix == id_key:
-                        id_dict[id_key] = value
-
-                if base_prefix in select_tables and base_prefix not in conf.identifiers:
-                    # if leaf reached and the field is not yet populated, set the value
-                    row = current_rows[base_prefix]
-                    if row.get_value(prefix) is None:
-                        row.set_value(prefix, value)
+    # rows receiving the leaves of each selected table, looked up by base prefix
+    selected_rows = {table: current_rows[table] for table in select_tables
+                     if table in current_rows and table not in id_dict}
+    # column indices of the identifiers in every table
+    id_positions = {table: tuple(current_rows[table].col_lookup[id_key] for id_key in id_dict)
+                    for table in current_rows}
 
-                    else:
-                        raise Exception(f"Multiple values with same prefix: {prefix}, value: {value}")
+    # leaves missing from a sampled mapping, collected per table for the current record
+    overflow = {table: {} for table in mappings if Mapping.OVERFLOW_COLUMN in mappings[table]}
 
-            # if reached end of a top-level json (i.e. finished one property)
-            elif prefix == '' and event == 'end_map' and value is None:
+    record_filter = RecordFilter(conf.where) if conf.where else None
+    rejected = False  # current record failed the record filter, its remaining values are skipped
 
-                for table in mappings:
-                    row = current_rows[table]
-                    # add identifiers to row
+    while True:
+        (base_prefix, prefix, event, value) = (yield)
+
+        if event == "string" or event == "number" or event == "boolean":
+            if record_filter is not None:
+                if not rejected and prefix in record_filter.conditions and not record_filter.test(prefix, value):
+                    rejected = True
+                # identifiers of rejected records are still needed to keep their state in record_hashes
+                if rejected and base_prefix not in id_dict:
+                    continue
+
+            if base_prefix in id_dict:
+                if id_dict[base_prefix] is None:
+                    id_dict[base_prefix] = value
+                continue
+
+            row = selected_rows.get(base_prefix)
+            if row is not None:
+                if base_prefix in overflow and prefix not in row.col_lookup:
+                    overflow[base_prefix][prefix] = value
+                    counts["overflow"] += 1
+
+                # if leaf reached and the field is not yet populated, set the value
+                elif row.get_value(prefix) is None:
+                    row.set_value(prefix, value)
+
+                else:
+                    raise Exception(f"Multiple values with same prefix: {prefix}, value: {value}")
+
+        # if reached end of a top-level json (i.e. finished one property)
+        elif prefix == '' and event == 'end_map' and value is None:
+            counts["records"] += 1
+
+            if record_filter is not None:
+                passed = record_filter.end_record() and not rejected
+                if not passed:
+                    # drop the record, only the rows that were given values need a reset
+                    for row in current_rows.values():
+                        if row.cells:
+                            row.reset()
+                    for table in overflow:
+                        overflow[table] = {}
+                    if record_hashes is not None:
+                        record_hashes.keep(list(id_dict.values()))
                     for id_key in id_dict:
-                        row.set_value(id_key, id_dict[id_key])
-
-                    row_buffer.append(table, row.get_row())
-
-                    # reset
-                    current_rows[table] = Row(len(row), index_lookup[table])
+                        id_dict[id_key] = None
+                    rejected = False
+                    counts["rejected"] += 1
+                    continue
+
+            id_values = list(id_dict.values())
+            ids_only = {}  # cells of the rows without values, shared by tables with the same identifier positions
+            rows = []
+            for table, row in current_rows.items():
+                if overflow.get(table):
+                    row.set_value(Mapping.OVERFLOW_COLUMN, json.dumps(overflow[table]))
+                    overflow[table] = {}
+
+                positions = id_positions[table]
+                if row.cells:
+                    # add identifiers to row
+                    for index, id_value in zip(positions, id_values):
+                        if id_value is not None:
+                            row.cells[index] = id_value
+                    rows.append(row.take_row())
+                else:
+                    cells = ids_only.get(positions)
+                    if cells is None:
+                        cells = {index: id_value for index, id_value in zip(positions, id_values)
+                                 if id_value is not None}
+                        ids_only[positions] = cells
+                    rows.append(SparseRow(row.size, cells))
+
+            if record_hashes is None or record_hashes.is_changed(id_values, rows):
+                for table, row in zip(current_rows, rows):
+                    row_buffer.append(table, row)
+
+            # reset variables
+            for id_key in id_dict:
+                id_dict[id_key] = None
+
+
+def flatten(files: FileHandler, select_tables: list, mappings: dict, writers: list, conf: Config,
+            record_hashes: RecordHashes = None) -> NoReturn:
+    """
+    Flatten json and output to csv
 
-                pbar.update(1)
+    :param files: output files
+    :param select_tables: selected tables to output
+    :param mappings: mapping dict specifying structure of output files
+    :param writers: list of output writers
+     :param conf: User specified configuration
+    :param record_hashes: if given, only output records that are new or changed since the previous run
+    """
+    import concurrent.futures
+    import ijson
 
-                # write all collected rows if total num rows exceeds specified size
-                if row_buffer.get_size() >= conf.chunk_size:
-                    # click.echo(f"writing {row_buffer.get_size()} rows...")
-                    for csvwriter, table in zip(writers, row_buffer.get_tables()):
-                        exe.submit(csvwriter.writerows, row_buffer.get_rows(table))
+    row_buffer = RowBuffer()
+    counts = Counter()
 
-                    row_buffer.reset()
+    pending_writes = {}  # last write submitted for every table
 
-                # reset variables
-                for id_key in id_dict:
-                    id_dict[id_key] = None
+    def write_rows(exe, writer, table):
+        """
+        Submit the buffered rows of table for writing, after the previous write to the same file
+        """
+        previous = pending_writes.get(table)
+        if previous is not None:
+            previous.result()
+        pending_writes[table] = exe.submit(writer.writerows, row_buffer.get_rows(table))
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=len(select_tables)) as executor:
 
-        with open_file(conf.json_file, mode="rb") as json_file:  # read bytes
-            for writer, table in zip(writers, mappings):
-                writer.writerow(list(mappings[table].keys()))
+        with open_range(conf.json_file, *conf.json_range) as json_file:  # read bytes
+            progress = Progress(conf.json_file, input_size(json_file), 'Flattening JSON',
+                                conf.progress, conf.progress_interval)
+            if conf.write_header:
+                for writer, table in zip(writers, mappings):
+                    if isinstance(writer, CSVEncoder):
+                        writer.writeheader()
+                    else:
+                        writer.writerow(list(mappings[table].keys()))
 
-            process_coro = process(executor)
+            process_coro = assemble_rows(row_buffer, select_tables, mappings, conf, counts, record_hashes)
             # send the events from custom parser to process coroutine
             parse_coro = utils.parse_coro(process_coro)
             # send the events and values from basic_parse to custom parser
@@ -122,6 +209,16 @@ def flatten(files: FileHandler, select_tables: list, mappings: dict, writers: li
 
             for chunk in json_bytes_from_file(json_file):
                 coro.send(chunk)  # push bytes to parser
+                progress.update(bytes_read(json_file), counts["records"])
+
+                # write all collected rows if total num rows exceeds specified size
+                if row_buffer.get_size() >= conf.chunk_size:
+                    for csvwriter, table in zip(writers, row_buffer.get_tables()):
+                        write_rows(executor, csvwriter, table)
+
+                    row_buffer.reset()
+
+            position = bytes_read(json_file)
 
         try:
             coro.close()
@@ -129,18 +226,267 @@ def flatten(files: FileHandler, select_tables: list, mappings: dict, writers: li
             click.echo(f"\nijson.IncompleteJSONError {e}", err=True)
             pass
         finally:
-            pbar.close()
-            click.echo()
+            progress.close(position, counts["records"])
+            if conf.progress != "json":
+                click.echo()
             # write any remaining rows
-            if row_buffer.get_size() > 0:
-                for w, t in zip(writers, row_buffer.get_tables()):
-                    executor.submit(w.writerows, row_buffer.get_rows(t))
-                    file = files.files[t]
-                    click.echo(f"Wrote {file['name']} with {len(mappings[t]):,} fields")
+            written = list(row_buffer.get_tables()) if row_buffer.get_size() > 0 else []
+            if written:
+                for w, t in zip(writers, written):
+                    write_rows(executor, w, t)
 
                 row_buffer.reset()
 
-            files.close()
+            # every write must be finished before the files are closed, errors of the writes are raised here
+            try:
+                for future in pending_writes.values():
+                    future.result()
+            finally:
+                files.close()
+
+            for t in written:
+                click.echo(f"Wrote {files.files[t]['name']} with {len(mappings[t]):,} fields")
+
+            if conf.where:
+                click.echo(f"{counts['rejected']:,} records did not match '--where' and were skipped")
+
+            if any(Mapping.OVERFLOW_COLUMN in mappings[table] for table in mappings):
+                click.echo(f"{counts['overflow']:,} values not found in mappings were written to "
+                           f"'{Mapping.OVERFLOW_COLUMN}' columns")
+
+
+async def _abytes(source, chunk_size: int = 65536):
+    """
+    Async generator that yields bytes from an async file-like object (with a `read` coroutine)
+    or from an async iterable of bytes
+
+    :param source: async byte source
+    """
+    if hasattr(source, "read"):
+        while True:
+            chunk = await source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        async for chunk in source:
+            yield chunk
+
+
+async def aflatten(source, mappings: dict, select_tables: Iterable = None, identifiers: Iterable = (),
+                   chunk_size: int = 1000, where: Iterable = ()):
+    """
+    Flatten json read from an async byte source
+
+    Async generator yielding `(table, rows)` batches, the rows being lists in the column order of mappings.
+    Runs on the event loop without threads: parsing happens between reads of the source.
+
+    eg.
+    async for table, rows in json2tab.aflatten(reader, mappings=mappings, identifiers=["factId"]):
+        ...
+
+    :param source: async file-like object with a `read` coroutine (eg. `asyncio.StreamReader`)
+        or async iterable of bytes
+    :param mappings: mapping dict specifying structure of output tables
+    :param select_tables: tables to output, defaults to every table in mappings
+    :param identifiers: top-level keys added to every table
+    :param chunk_size: number of rows to collect before yielding them
+    :param where: expressions records must match to be output, see `--where`
+    """
+    import ijson
+
+    conf = Config("", "", chunk_size)
+    conf.identifiers = tuple(identifiers)
+    conf.where = tuple(where)
+    if select_tables is not None:
+        # like the command line, only the selected tables are assembled
+        mappings = {table: mappings[table] for table in mappings if table in select_tables}
+    select_tables = list(mappings)
+
+    row_buffer = RowBuffer()
+    counts = Counter()
+    coro = ijson.basic_parse_coro(
+        utils.parse_coro(assemble_rows(row_buffer, select_tables, mappings, conf, counts)),
+        multiple_values=True, use_float=True)
+
+    async for chunk in _abytes(source):
+        coro.send(chunk)  # push bytes to parser
+
+        if row_buffer.get_size() >= chunk_size:
+            for table in list(row_buffer.get_tables()):
+                yield table, [row.to_list() for row in row_buffer.get_rows(table)]
+            row_buffer.reset()
+
+    coro.close()
+
+    for table in list(row_buffer.get_tables()):
+        yield table, [row.to_list() for row in row_buffer.get_rows(table)]
+    row_buffer.reset()
+
+
+async def aconvert(source, sink: AsyncSink, mappings: dict, select_tables: Iterable = None,
+                   identifiers: Iterable = (), chunk_size: int = 1000, where: Iterable = ()) -> int:
+    """
+    Flatten json read from an async byte source and write the rows to an async sink
+
+    :param source: async byte source, see `aflatten`
+    :param sink: destination of the rows, eg. `AsyncCSVSink`
+    :param mappings: mapping dict specifying structure of output tables
+    :param select_tables: tables to output, defaults to every table in mappings
+    :param identifiers: top-level keys added to every table
+    :param chunk_size: number of rows to collect before writing them
+    :param where: expressions records must match to be output, see `--where`
+    :return: number of rows written
+    """
+    if select_tables is not None:
+        mappings = {table: mappings[table] for table in mappings if table in select_tables}
+    num_rows = 0
+    await sink.open(mappings)
+    try:
+        async for table, rows in aflatten(source, mappings, select_tables, identifiers, chunk_size, where):
+            await sink.write_rows(table, rows)
+            num_rows = num_rows + len(rows)
+    finally:
+        await sink.close()
+    return num_rows
+
+
+def convert_file(json_file: str, out_dir: str, filename: str, select_tables: list, mappings: dict, conf: Config) -> int:
+    """
+    Flatten one json file to one output file per table in mappings
+
+    :param json_file: input json file path
+    :param out_dir: output directory
+    :param filename: prefix of the output file names
+    :param select_tables: selected tables to output
+    :param mappings: mapping dict specifying structure of output files
+    :param conf: User specified configuration
+    :return: number of files written
+    """
+    conf = copy.copy(conf)
+    conf.json_file = json_file
+
+    if conf.sqlite_file:
+        import sqlite3
+
+        try:
+            out_files = SQLiteHandler(conf.sqlite_file, mappings)
+        except sqlite3.Error as e:
+            raise click.ClickException(f"Cannot create tables in {conf.sqlite_file}: {e}")
+        writers = out_files.writers()
+        conf.write_header = False
+        for table in out_files.split_tables:
+            click.echo(click.style(f"Warning: table '{table}' has more columns than SQLite allows, the values of its "
+                                   f"least filled columns are stored in a json '_extra' column", fg='yellow'))
+    else:
+        # open all CSV files, creates them if they don't exist
+        out_files = FileHandler()
+
+        for key in mappings.keys():
+            out_files.open(key, Path(out_dir) / f'{filename}_{key}{conf.extension}', mode='wt', encoding='utf-8',
+                           newline='')
+
+        # Create list of writers
+        files = out_files.files
+        # note - The order of writers is the same as the order of top-level keys in mappings
+        if conf.csv_module:
+            writers = [csv.writer(files[table]['file']) for table in mappings]
+        else:
+            writers = [CSVEncoder(files[table]['file'], list(mappings[table].keys())) for table in mappings]
+
+    record_hashes = RecordHashes(conf.state_file, mappings, conf.identifiers) if conf.state_file else None
+
+    try:
+        flatten(out_files, list(select_tables), mappings, writers, conf, record_hashes)
+    except DuplicateIdentifierError as e:
+        out_files.close()
+        raise click.ClickException(f"{e}. The state file {conf.state_file} was not updated.")
+
+    num_files = out_files.size()
+
+    if record_hashes is not None:
+        deleted = record_hashes.deleted()
+        with open_file(str(Path(out_dir) / f'{filename}_deletions{conf.extension}'), mode='wt', encoding='utf-8',
+                       newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(conf.identifiers))
+            writer.writerows(deleted)
+        record_hashes.save()
+        num_files = num_files + 1
+
+        click.echo(f"{record_hashes.changed:,} new or changed records, {record_hashes.unchanged:,} unchanged records, "
+                   f"{len(deleted):,} deleted records")
+
+    return num_files
+
+
+def output_names(json_files: list) -> list:
+    """
+    Unique prefix of the output file names of every input file
+
+    The file name without its extension is used, eg. "data" for "a/data.json".
+    When names collide, eg. for "a/data.json" and "b/data.json", the path relative to the common directory
+    of the inputs is used instead, eg. "a_data" and "b_data".
+
+    :param json_files: input json file paths
+    :return: output file name prefixes, in the order of json_files
+    """
+    names = [Path(json_file).name.split(".json")[0] for json_file in json_files]
+    if len(set(names)) == len(names):
+        return names
+
+    common = os.path.commonpath([os.path.abspath(os.path.dirname(json_file)) for json_file in json_files])
+    names = [os.path.relpath(os.path.abspath(json_file), common).split(".json")[0].replace(os.sep, "_")
+             for json_file in json_files]
+    if len(set(names)) < len(names):
+        # eg. "a_b/data.json" and "a/b_data.json"
+        names = [f"{i:05d}_{name}" for i, name in enumerate(names)]
+    return names
+
+
+def convert_files(json_files: list, out_dir: str, filename: str, select_tables: list, mappings: dict, conf: Config,
+                  combine: bool, max_workers=None) -> int:
+    """
+    Flatten several json files sharing the same mappings in a process pool
+
+    :param json_files: input json file paths
+    :param out_dir: output directory
+    :param filename: prefix of the combined output file names
+    :param select_tables: selected tables to output
+    :param mappings: mapping dict specifying structure of output files
+    :param conf: User specified configuration
+    :param combine: concatenate the outputs of all files into one file per table,
+        otherwise every input file gets its own output files
+    :param max_workers: number of processes, defaults to the number of processors
+    :return: number of files written
+    """
+    import concurrent.futures
+    import shutil
+    import tempfile
+
+    part_dir = tempfile.mkdtemp(dir=out_dir) if combine else out_dir
+
+    names = [f"{i:05d}" for i in range(len(json_files))] if combine else output_names(json_files)
+
+    futures = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for i, (json_file, name) in enumerate(zip(json_files, names)):
+            file_conf = copy.copy(conf)
+            # combined tables only keep the header of the first part
+            file_conf.write_header = conf.write_header and (i == 0 or not combine)
+            futures.append(executor.submit(convert_file, json_file, part_dir, name, select_tables, mappings,
+                                           file_conf))
+
+    num_files = sum(future.result() for future in futures)
+
+    if combine:
+        for key in mappings:
+            parts = [Path(part_dir) / f'{i:05d}_{key}{conf.extension}' for i in range(len(json_files))]
+            concat_files(parts, Path(out_dir) / f'{filename}_{key}{conf.extension}')
+        shutil.rmtree(part_dir)
+        num_files = len(mappings)
+
+    return num_files
 
 
 def prompt_tables(top_keys: Iterable) -> Iterable:
@@ -189,9 +535,37 @@ def prompt_ids(top_keys: Iterable) -> Iterable:
     return identifiers
 
 
-@click.command()
-@click.option('--filepath', '-f', help='Input JSON file path. The file extension must be .json or .json.gz',
-              required=True, type=click.Path(exists=True))
+class DefaultGroup(click.Group):
+    """
+    Group of commands that runs its default command when no command name is given,
+    so `json2tab -f file.json -o out` keeps working next to `json2tab plan ...`
+    """
+
+    def __init__(self, *args, default_command=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] != '--help':
+            args.insert(0, self.default_command)
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup, default_command='convert')
+def main():
+    """
+    Program that flattens JSON file and converts to CSV
+
+    Runs the convert command when no command is given.
+    """
+
+
+@main.command()
+@click.option('--filepath', '-f', help="""
+              Input JSON file path, directory or quoted glob pattern eg. "shards/*.json.gz".
+              The file extension must be .json or .json.gz
+              """,
+              required=True, type=click.Path())
 @click.option('--out', '-o', help='Output directory', required=True, type=click.Path(file_okay=False))
 @click.option('--identifier', '-id',
               help="""
@@ -223,8 +597,8 @@ def prompt_ids(top_keys: Iterable) -> Iterable:
             Important note: the mappings file will be created by default when all keys are being processed 
             (eg. user specifies --all-keys).
               """)
-@click.option('--mapping-file', '-m', help="""
-            Specify mappings json file to re-use from a previous run of the program. 
+@click.option('--mapping-file', '-m', help=f"""
+            Specify mappings json or binary ({mapfile.EXTENSION}) file to re-use from a previous run of the program. 
             Saves time by skipping create mappings portion of the program.
             """,
               type=click.Path(exists=True))
@@ -232,20 +606,67 @@ def prompt_ids(top_keys: Iterable) -> Iterable:
             Disables the automatic creation of the mappings json file when all keys are being processed .
             (eg. user specifies --all-keys)""",
               is_flag=True)
-def main(filepath, out, identifier, table, compress, chunk_size, exclude, all_keys, only_create_map, mapping_file,
-         no_map):
-    """Program that flattens JSON file and converts to CSV"""
+@click.option('--sample', '-s', type=int, default=0, help="""
+            Create mappings from a random sample of this many records instead of reading every record.
+            Values not found in the sampled mappings are written to an '_overflow' json column.
+            Requires one json per line.""")
+@click.option('--sample-fraction', '-sf', type=float, default=0.0, help="""
+            Create mappings from a random fraction (between 0 and 1) of the records instead of reading every record.
+            Mutually exclusive with '--sample' / '-s'.""")
+@click.option('--combine', is_flag=True, help="""
+            When several input files are given, write one combined output file per table
+            instead of separate output files for every input file.""")
+@click.option('--workers', '-w', type=int, default=None,
+              help='Number of processes used when several input files are given. Defaults to the number of processors.')
+@click.option('--state-file', type=click.Path(dir_okay=False), default=None, help="""
+            File keeping a hash of every record by its identifier values between runs (created if missing).
+            Only records that are new or changed since the previous run are written,
+            along with a deletions file of the identifiers that disappeared.
+            Requires '--identifier' / '-id' with values unique to every record.""")
+@click.option('--where', '-wh', multiple=True, default=(), help="""
+            Only output records matching an expression on a leaf, eg. --where 'site.status == "active"'
+            or --where 'rollNumber in rolls.txt' (one value per line). Supported operators are
+            ==, !=, in and not in. Values are compared as text with integral numbers written without decimals,
+            so 3, 3.0 and "3" are equal. You can add this flag multiple times, records must match every expression.""")
+@click.option('--sqlite', type=click.Path(dir_okay=False), default=None, help="""
+            Load the tables into this SQLite database instead of writing CSV files.
+            Column types are inferred when creating mappings. Tables are replaced if they exist.
+            Rows are inserted in one transaction per '--chunk-size' rows, so use a large chunk size.
+            SQLite tables have at most 2000 columns by default: wider tables keep the identifiers and their most
+            filled columns, the other values of each row are stored as a json object in an '_extra' column.
+            Names differing only in case get a numeric suffix, eg. 'a.name_2', as SQLite ignores case.""")
+@click.option('--csv-module', is_flag=True, help="""
+            Write rows with Python's csv module instead of the faster built-in encoder. Both give identical output.""")
+@click.option('--progress', type=click.Choice(['bar', 'json', 'none']), default='bar', help="""
+            How to report the progress of creating mappings and flattening, measured in bytes of the input read
+            (compressed bytes for .gz):
+            a progress bar, json lines on stderr for other programs, or nothing.""")
+@click.option('--progress-interval', type=float, default=1.0, help='Seconds between progress reports.')
+@click.option('--binary-mapping', is_flag=True, help=f"""
+            Save the mappings in the compact binary format ({mapfile.EXTENSION}) instead of json,
+            faster to write and load for very wide tables.""")
+def convert(filepath, out, identifier, table, compress, chunk_size, exclude, all_keys, only_create_map, mapping_file,
+            no_map, sample, sample_fraction, combine, workers, state_file, where, sqlite, csv_module, progress,
+            progress_interval, binary_mapping):
+    """Flatten JSON file and convert to CSV (default command)"""
 
     def validate_inputs():
         """
         Validate the program options specified
         """
-        # Specified file has extension .json
-        if not filepath.endswith(".json") and not filepath.endswith(".json.gz"):
+        if not json_files:
             raise click.exceptions.BadOptionUsage(option_name='--filepath',
-                                                  message=f"Invalid value for '--filepath' / '-f': Input file {filepath} extension is not .json or .json.gz")
-
-        t_keys = get_top_keys(filepath)
+                                                  message=f"Invalid value for '--filepath' / '-f': No .json or .json.gz files found for {filepath}")
+        for json_file in json_files:
+            if not os.path.isfile(json_file):
+                raise click.exceptions.BadOptionUsage(option_name='--filepath',
+                                                      message=f"Invalid value for '--filepath' / '-f': Path '{json_file}' does not exist")
+            # Specified file has extension .json
+            if not json_file.endswith(".json") and not json_file.endswith(".json.gz"):
+                raise click.exceptions.BadOptionUsage(option_name='--filepath',
+                                                      message=f"Invalid value for '--filepath' / '-f': Input file {json_file} extension is not .json or .json.gz")
+
+        t_keys = get_top_keys(json_files[0])
 
         # check identifiers are top level keys
         if identifier:
@@ -289,12 +710,47 @@ def main(filepath, out, identifier, table, compress, chunk_size, exclude, all_ke
                     raise click.exceptions.BadOptionUsage(option_name='--exclude',
                                                           message=f"Invalid value for '--exclude' / '-e': At least one of {exclude} was specified as an identifier")
 
+        if sample and sample_fraction:
+            raise click.exceptions.BadOptionUsage(option_name='--sample',
+                                                  message=f"Options '--sample' / '-s' and '--sample-fraction' / '-sf' cannot be used in the same command.")
+        if sample < 0:
+            raise click.exceptions.BadOptionUsage(option_name='--sample',
+                                                  message=f"Invalid value for '--sample' / '-s': {sample} is negative")
+        if sample_fraction and not 0 < sample_fraction <= 1:
+            raise click.exceptions.BadOptionUsage(option_name='--sample-fraction',
+                                                  message=f"Invalid value for '--sample-fraction' / '-sf': {sample_fraction} is not between 0 and 1")
+        if mapping_file and (sample or sample_fraction):
+            raise click.exceptions.BadOptionUsage(option_name='--mapping-file',
+                                                  message=f"Options '--mapping-file' / '-m' and '--sample' / '--sample-fraction' cannot be used in the same command.")
+        for expression in where:
+            try:
+                RecordFilter([expression])
+            except (ValueError, OSError) as e:
+                raise click.exceptions.BadOptionUsage(option_name='--where',
+                                                      message=f"Invalid value for '--where' / '-wh': {e}")
+        if sqlite and len(json_files) > 1:
+            raise click.exceptions.BadOptionUsage(option_name='--sqlite',
+                                                  message=f"Option '--sqlite' can only be used with a single input file.")
+        if state_file and len(json_files) > 1:
+            raise click.exceptions.BadOptionUsage(option_name='--state-file',
+                                                  message=f"Option '--state-file' can only be used with a single input file.")
+
         if mapping_file:
-            if not mapping_file.endswith(".json"):
+            if not mapping_file.endswith(".json") and not mapfile.is_binary(mapping_file):
                 raise click.exceptions.BadOptionUsage(option_name='--mapping-file',
-                                                      message=f"Invalid value for '--mapping-file' / '-m': Mapping file must be .json file")
+                                                      message=f"Invalid value for '--mapping-file' / '-m': Mapping file must be .json or {mapfile.EXTENSION} file")
 
-            mapping_keys = get_top_keys(mapping_file)
+            nonlocal mappings
+            try:
+                if mapfile.is_binary(mapping_file):
+                    # only the table directory is read, tables are loaded once validated
+                    mapping_keys = mapfile.read_table_names(mapping_file)
+                else:
+                    mappings = mapfile.load_mappings(mapping_file)
+                    mapping_keys = list(mappings)
+            except ValueError as e:
+                raise click.exceptions.BadOptionUsage(option_name='--mapping-file',
+                                                      message=f"Invalid value for '--mapping-file' / '-m': {e}")
 
             if not (set(mapping_keys).issubset(set(t_keys))):
                 raise click.exceptions.BadOptionUsage(option_name='--mapping-file',
@@ -323,19 +779,27 @@ def main(filepath, out, identifier, table, compress, chunk_size, exclude, all_ke
             mappings.pop(t)
         click.echo()
 
+    json_files = get_input_files(filepath)
+    mappings = None  # loaded by validate_inputs when a json mapping file is given
+
     validate_inputs()
 
-    config = Config(filepath, out, chunk_size)
+    config = Config(json_files[0], out, chunk_size)
+    config.sample_size = sample
+    config.sample_fraction = sample_fraction
     cli = Cmd()
 
-    click.echo(f"Input file: {filepath}")
+    if len(json_files) == 1:
+        click.echo(f"Input file: {filepath}")
+    else:
+        click.echo(f"Input files: {len(json_files)} files matching {filepath}")
     click.echo(f"Output path: {out}")  # note to self: fix this to show full filesystem path
 
     if only_create_map:
         click.echo(
             "'--only-create-map', '-ocm' specified. Program will shut down after creating mappings file on all keys.")
 
-    top_keys = get_top_keys(filepath)
+    top_keys = get_top_keys(json_files[0])
 
     if not table and not exclude and not all_keys and not only_create_map:
         print(f"\nTop-level keys:\n=================")
@@ -358,25 +822,47 @@ def main(filepath, out, identifier, table, compress, chunk_size, exclude, all_ke
         identifier = prompt_ids(top_keys)
     config.identifiers = identifier
 
+    if state_file and not config.identifiers:
+        raise click.exceptions.BadOptionUsage(option_name='--state-file',
+                                              message=f"Option '--state-file' requires at least one '--identifier' / '-id'.")
+    config.state_file = state_file
+    config.where = where
+    config.sqlite_file = sqlite
+    config.csv_module = csv_module
+    config.progress = progress
+    config.progress_interval = progress_interval
+
     # remove any identifiers from tables var
     for idt in config.identifiers:
         if idt in tables:
             tables.remove(idt)
 
-    filename = Path(filepath).stem.strip(".json")
+    if len(json_files) == 1:
+        filename = Path(json_files[0]).stem.strip(".json")
+    else:
+        filename = "combined"
 
     if mapping_file:
         click.echo(f"\nUsing mapping file {mapping_file}")
-        with open(mapping_file, 'r') as f:
-            mappings = json.load(f)
+        # only the selected tables are decoded from a binary mapping file
+        if mappings is None:
+            try:
+                mappings = mapfile.load_mappings(mapping_file, tables)
+            except ValueError as e:
+                raise click.exceptions.BadOptionUsage(option_name='--mapping-file',
+                                                      message=f"Invalid value for '--mapping-file' / '-m': {e}")
+        else:
+            mappings = {t: mappings[t] for t in mappings if t in tables}
     else:
-        mappings = Mapping.create_mappings(tables, config)
+        if len(json_files) == 1:
+            mappings = Mapping.create_mappings(tables, config)
+        else:
+            mappings = Mapping.create_mappings_multi(tables, config, json_files, workers)
 
         # only output mappings json if all keys or only_create_map specified
         if (not no_map and all_keys) or only_create_map:
-            mapping_path = Path(out) / f'{filename}_mappings.json'
-            with open(mapping_path, 'w') as f:
-                json.dump(mappings, f)
+            mapping_path = Path(out) / f'{filename}_mappings{mapfile.EXTENSION if binary_mapping else ".json"}'
+            mapfile.save_mappings(mappings, mapping_path)
             click.echo(f"Saved mappings to: {mapping_path}")
 
     if only_create_map:
@@ -392,23 +878,220 @@ def main(filepath, out, identifier, table, compress, chunk_size, exclude, all_ke
     remove_empty_tables()
 
     if compress:
-        extension = '.csv.gz'
+        config.extension = '.csv.gz'
     else:
-        extension = '.csv'
+        config.extension = '.csv'
 
-    # open all CSV files, creates them if they don't exist
-    out_files = FileHandler()
+    if len(json_files) == 1:
+        num_files = convert_file(json_files[0], out, filename, list(tables), mappings, config)
+    else:
+        num_files = convert_files(json_files, out, filename, list(tables), mappings, config, combine, workers)
 
-    for key in mappings.keys():
-        out_files.open(key, Path(out) / f'{filename}_{key}{extension}', mode='wt', encoding='utf-8', newline='')
+    if sqlite:
+        click.echo(f"\n{num_files} tables written to {sqlite}\n")
+    else:
+        click.echo(f"\n{num_files} files written to {out}\n")
 
-    # Create list of writers
-    files = out_files.files
-    # note - The order of writers is the same as the order of top-level keys in mappings
-    writers = [csv.writer(files[table]['file']) for table in mappings]
+    # click.echo(f"Number of json lines written into each file is: {Flatten.count_rows}")
 
-    flatten(out_files, list(tables), mappings, writers, config)
 
-    click.echo(f"\n{out_files.size()} files written to {out}\n")
+@main.command()
+@click.option('--filepath', '-f', required=True, type=click.Path(),
+              help='Input JSON file path, directory or quoted glob pattern')
+@click.option('--json', 'as_json', is_flag=True, help='Print the report as json')
+def inspect(filepath, as_json):
+    """Report the top-level keys, size and estimated number of records of JSON files"""
+    json_files = get_input_files(filepath)
+    if not json_files:
+        raise click.exceptions.BadOptionUsage(option_name='--filepath',
+                                              message=f"Invalid value for '--filepath' / '-f': No .json or .json.gz files found for {filepath}")
+    for json_file in json_files:
+        if not os.path.isfile(json_file):
+            raise click.exceptions.BadOptionUsage(option_name='--filepath',
+                                                  message=f"Invalid value for '--filepath' / '-f': Path '{json_file}' does not exist")
 
-    # click.echo(f"Number of json lines written into each file is: {Flatten.count_rows}")
+    probes = [probe_file(json_file) for json_file in json_files]
+    if as_json:
+        click.echo(json.dumps(probes if len(probes) > 1 else probes[0], indent=2))
+        return
+
+    cli = Cmd()
+    for probe in probes:
+        records = probe["estimated_records"]
+        click.echo(f"\nFile: {probe['path']}")
+        click.echo(f"Size: {probe['size']:,} bytes")
+        click.echo(f"Compression: {probe['compression']}")
+        click.echo(f"Records: {'unknown (not one json per line)' if records is None else f'~{records:,}'}")
+        click.echo(f"\nTop-level keys:\n=================")
+        cli.columnize(probe["top_keys"], displaywidth=80)
+
+
+@main.command()
+@click.option('--filepath', '-f', help='Input JSON file path, one json per line. The file extension must be .json or .json.gz',
+              required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--out', '-o', help='Directory to write the manifest and mappings to', required=True,
+              type=click.Path(file_okay=False))
+@click.option('--shards', '-n', help='Number of shards to split the input file into', required=True, type=int)
+@click.option('--identifier', '-id', help="Top-level key to add as identifier col to every output file.",
+              default=(), multiple=True)
+@click.option('--table', '-t', help="Top-level key to convert. Defaults to every top-level key.",
+              default=(), multiple=True)
+@click.option('--mapping-file', '-m', help="Mappings json or binary file to re-use instead of creating mappings.",
+              type=click.Path(exists=True, dir_okay=False))
+@click.option('--sample', '-s', type=int, default=0, help="Create mappings from a random sample of this many records.")
+@click.option('--sample-fraction', '-sf', type=float, default=0.0,
+              help="Create mappings from a random fraction (between 0 and 1) of the records.")
+@click.option('--compress', '-c', help="Output compressed csv files eg. output_file.csv.gz", is_flag=True)
+@click.option('--chunk-size', '-cs', type=int, default=1,
+              help='Number of rows to keep in memory before writing for each file.')
+@click.option('--binary-mapping', is_flag=True, help=f"""
+            Save the mappings in the compact binary format ({mapfile.EXTENSION}) instead of json,
+            faster to write and load for very wide tables.""")
+def plan(filepath, out, shards, identifier, table, mapping_file, sample, sample_fraction, compress, chunk_size,
+         binary_mapping):
+    """
+    Split a JSON file into record-aligned shards
+
+    Writes a manifest of the shard ranges along with the mappings shared by every shard.
+    Each shard is then processed with `json2tab run` and the outputs joined with `json2tab merge`.
+    """
+    if not filepath.endswith(".json") and not filepath.endswith(".json.gz"):
+        raise click.exceptions.BadOptionUsage(option_name='--filepath',
+                                              message=f"Invalid value for '--filepath' / '-f': Input file {filepath} extension is not .json or .json.gz")
+    if shards < 1:
+        raise click.exceptions.BadOptionUsage(option_name='--shards',
+                                              message=f"Invalid value for '--shards' / '-n': {shards} is less than 1")
+    if mapping_file and (sample or sample_fraction):
+        raise click.exceptions.BadOptionUsage(option_name='--mapping-file',
+                                              message=f"Options '--mapping-file' / '-m' and '--sample' / '--sample-fraction' cannot be used in the same command.")
+
+    top_keys = get_top_keys(filepath)
+    for option_name, keys in (('--identifier', identifier), ('--table', table)):
+        if not set(keys).issubset(set(top_keys)):
+            raise click.exceptions.BadOptionUsage(option_name=option_name,
+                                                  message=f"Invalid value for '{option_name}': At least one of {keys} is not a top-level key")
+
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    config = Config(filepath, out, chunk_size)
+    config.identifiers = identifier
+    config.sample_size = sample
+    config.sample_fraction = sample_fraction
+
+    tables = [t for t in (table or top_keys) if t not in identifier]
+
+    if mapping_file:
+        click.echo(f"Using mapping file {mapping_file}")
+        try:
+            mappings = mapfile.load_mappings(mapping_file, tables)
+        except ValueError as e:
+            raise click.exceptions.BadOptionUsage(option_name='--mapping-file',
+                                                  message=f"Invalid value for '--mapping-file' / '-m': {e}")
+    else:
+        mappings = Mapping.create_mappings(tables, config)
+
+    # tables without values get no output file
+    mappings = {t: mappings[t] for t in mappings if len(mappings[t]) > len(identifier)}
+
+    filename = Path(filepath).stem.strip(".json")
+    mapping_name = f'{filename}_mappings{mapfile.EXTENSION if binary_mapping else ".json"}'
+    mapfile.save_mappings(mappings, Path(out) / mapping_name)
+
+    manifest_path = Path(out) / f'{filename}_manifest.json'
+    manifest = write_manifest(manifest_path, filepath, filename, mapping_name, list(mappings), identifier, shards,
+                              '.csv.gz' if compress else '.csv', chunk_size)
+
+    click.echo(f"Planned {len(manifest['shards'])} shards of {filepath} split on {manifest['unit']}")
+    click.echo(f"Saved manifest to: {manifest_path}")
+
+
+@main.command()
+@click.option('--manifest', '-mf', help='Manifest written by `json2tab plan`', required=True,
+              type=click.Path(exists=True, dir_okay=False))
+@click.option('--shard', '-k', help='Index of the shard to process, starting from 0', required=True, type=int)
+@click.option('--out', '-o', help='Output directory. Defaults to the manifest directory', default=None,
+              type=click.Path(file_okay=False))
+@click.option('--filepath', '-f', help='Local copy of the input JSON file. Defaults to the path in the manifest',
+              default=None, type=click.Path(exists=True, dir_okay=False))
+@click.option('--progress', type=click.Choice(['bar', 'json', 'none']), default='bar', help="""
+            How to report the progress of creating mappings and flattening, measured in bytes of the input read
+            (compressed bytes for .gz):
+            a progress bar, json lines on stderr for other programs, or nothing.""")
+@click.option('--progress-interval', type=float, default=1.0, help='Seconds between progress reports.')
+def run(manifest, shard, out, filepath, progress, progress_interval):
+    """Flatten one shard of a planned JSON file"""
+    manifest_dir = Path(manifest).parent
+    shard_plan = read_manifest(manifest)
+
+    if not 0 <= shard < len(shard_plan['shards']):
+        raise click.exceptions.BadOptionUsage(option_name='--shard',
+                                              message=f"Invalid value for '--shard' / '-k': {shard} is not between 0 and {len(shard_plan['shards']) - 1}")
+
+    try:
+        check_input(shard_plan, filepath or shard_plan['input'])
+    except (ValueError, OSError) as e:
+        raise click.exceptions.BadOptionUsage(option_name='--filepath',
+                                              message=f"Invalid value for '--filepath' / '-f': {e}")
+
+    out = out or str(manifest_dir)
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    mappings = mapfile.load_mappings(manifest_dir / shard_plan['mapping_file'], shard_plan['tables'])
+
+    config = Config(filepath or shard_plan['input'], out, shard_plan['chunk_size'])
+    config.identifiers = shard_plan['identifiers']
+    config.extension = shard_plan['extension']
+    config.json_range = (*shard_plan['shards'][shard], shard_plan['unit'])
+    # only the first shard writes the header, so the parts can be concatenated as is
+    config.write_header = shard == 0
+    config.progress = progress
+    config.progress_interval = progress_interval
+
+    num_files = convert_file(config.json_file, out, part_name(shard_plan, shard), shard_plan['tables'], mappings,
+                             config)
+
+    click.echo(f"\nShard {shard}: {num_files} files written to {out}\n")
+
+
+@main.command()
+@click.option('--manifest', '-mf', help='Manifest written by `json2tab plan`', required=True,
+              type=click.Path(exists=True, dir_okay=False))
+@click.option('--parts', '-p', help='Directory holding the outputs of every shard. Defaults to the manifest directory',
+              default=None, type=click.Path(exists=True, file_okay=False))
+@click.option('--out', '-o', help='Output directory. Defaults to the manifest directory', default=None,
+              type=click.Path(file_okay=False))
+@click.option('--remove-parts', help='Delete the outputs of every shard once merged', is_flag=True)
+def merge(manifest, parts, out, remove_parts):
+    """Concatenate the outputs of every shard of a planned JSON file in order"""
+    manifest_dir = Path(manifest).parent
+    shard_plan = read_manifest(manifest)
+
+    out = out or str(manifest_dir)
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    try:
+        merged = merge_parts(shard_plan, parts or manifest_dir, out, remove_parts)
+    except FileNotFoundError as e:
+        raise click.ClickException(str(e))
+
+    for path in merged:
+        click.echo(f"Wrote {path}")
+    click.echo(f"\n{len(merged)} files written to {out}\n")
+
+
+@main.command('convert-mapping')
+@click.option('--input', '-i', 'source', required=True, type=click.Path(exists=True, dir_okay=False),
+              help=f'Mapping file to convert, .json or {mapfile.EXTENSION}')
+@click.option('--output', '-o', 'destination', required=True, type=click.Path(dir_okay=False),
+              help=f'Mapping file to write, .json or {mapfile.EXTENSION}')
+def convert_mapping(source, destination):
+    """Convert a mapping file between the json and binary formats, following the file extensions"""
+    try:
+        mappings = mapfile.load_mappings(source)
+    except ValueError as e:
+        raise click.exceptions.BadOptionUsage(option_name='--input', message=f"Invalid value for '--input' / '-i': {e}")
+    mapfile.save_mappings(mappings, destination)
+    click.echo(f"Saved {len(mappings)} tables to: {destination}")
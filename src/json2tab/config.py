@@ -3,6 +3,17 @@ class Config:
     out_dir = ""
     identifiers = ()
     chunk_size = 0
+    sample_size = 0  # number of records to sample when creating mappings, 0 reads every record
+    sample_fraction = 0.0  # fraction of records to sample when creating mappings
+    extension = ".csv"  # extension of the output files, .csv or .csv.gz
+    write_header = True  # write the column names as the first row of each output file
+    json_range = (0, None, "bytes")  # (start, end, unit) of the part of json_file to flatten
+    state_file = None  # record hashes of the previous run, only new or changed records are written when set
+    where = ()  # expressions records must match to be written
+    sqlite_file = None  # SQLite database to load the tables into instead of CSV files
+    csv_module = False  # write rows with the csv module instead of `CSVEncoder`
+    progress = "bar"  # progress of flattening: "bar", "json" lines on stderr or "none"
+    progress_interval = 1.0  # seconds between progress reports
 
     def __init__(self, json_file, out_dir, chunk_size):
         self.json_file = json_file
@@ -0,0 +1,114 @@
+import json
+import re
+from typing import Iterable
+
+EXPRESSION = re.compile(r'^\s*(?P<path>[^\s!=]+)\s*(?P<op>==|!=|not\s+in\b|in\b)\s*(?P<operand>.+?)\s*$')
+
+
+def _normalize(value):
+    """
+    Text form of a leaf value used by every comparison: strings are kept as they are, integral numbers lose
+    their fractional part and other values are written as json, eg. 3.0 -> '3', 2.5 -> '2.5', True -> 'true'
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return json.dumps(value)
+
+
+def _parse_literal(text: str):
+    """
+    Parse a json literal, unquoted text is taken as a string
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+class Condition:
+    """
+    Single predicate on the value of one leaf, eg. `site.status == "active"` or `rollNumber in ids.txt`
+
+    The operand of `in` / `not in` is either a json list or a text file with one value per line.
+    Every operator compares the text form of values given by `_normalize`, so 3, 3.0 and "3" are equal.
+    A missing leaf only equals null.
+    """
+
+    def __init__(self, expression: str):
+        match = EXPRESSION.match(expression)
+        if match is None:
+            raise ValueError(f"Invalid expression '{expression}', expected '<path> ==|!=|in|not in <value>'")
+
+        self.expression = expression
+        self.path = match.group('path')
+        self.op = ' '.join(match.group('op').split())
+        operand = match.group('operand')
+
+        if self.op in ('in', 'not in'):
+            if operand.startswith('['):
+                values = json.loads(operand)
+            else:
+                with open(operand, 'r', encoding='utf-8') as f:
+                    values = [_parse_literal(line.strip()) for line in f if line.strip()]
+            self.operand = {_normalize(v) for v in values if v is not None}
+        else:
+            literal = _parse_literal(operand)
+            self.operand = None if literal is None else _normalize(literal)
+
+    def test(self, value) -> bool:
+        """
+        Whether a leaf value satisfies the condition, a missing leaf has value None
+        """
+        if self.op in ('==', '!='):
+            if value is None or self.operand is None:
+                equal = value is None and self.operand is None
+            else:
+                equal = _normalize(value) == self.operand
+            return equal if self.op == '==' else not equal
+        found = value is not None and _normalize(value) in self.operand
+        return found if self.op == 'in' else not found
+
+
+class RecordFilter:
+    """
+    Conjunction of conditions evaluated while a record is being parsed
+
+    Each condition is tested as soon as its leaf is parsed, so a failing record can be rejected
+    before the rest of its values are processed.
+    """
+
+    def __init__(self, expressions: Iterable):
+        self.conditions = {}  # leaf prefix -> conditions on that leaf
+        for expression in expressions:
+            condition = Condition(expression)
+            self.conditions.setdefault(condition.path, []).append(condition)
+        self.seen = set()  # leaves tested in the current record
+
+    def test(self, prefix: str, value) -> bool:
+        """
+        Test the conditions on one leaf of the current record
+
+        :param prefix: prefix of the leaf
+        :param value: value of the leaf
+        :return: False if the record fails any condition
+        """
+        self.seen.add(prefix)
+        for condition in self.conditions[prefix]:
+            if not condition.test(value):
+                return False
+        return True
+
+    def end_record(self) -> bool:
+        """
+        Test the conditions on leaves missing from the current record and start a new record
+
+        :return: False if the record fails any condition
+        """
+        passed = True
+        for prefix in self.conditions:
+            if prefix not in self.seen:
+                passed = passed and all(condition.test(None) for condition in self.conditions[prefix])
+        self.seen = set()
+        return passed
@@ -1,6 +1,13 @@
 from collections import defaultdict
+import csv
 import gzip
-from queue import Queue
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from typing import Iterable
 
 
 def open_file(filepath: str, **kwargs):
@@ -15,25 +22,301 @@ def open_file(filepath: str, **kwargs):
         return open(filepath, **kwargs)
 
 
+def concat_files(sources, destination):
+    """
+    Concatenate files byte for byte into destination
+
+    Compressed sources become separate members of one valid gzip file.
+
+    :param sources: paths of the files to concatenate, in order
+    :param destination: path of the resulting file
+    """
+    with open(destination, "wb") as out:
+        for source in sources:
+            with open(source, "rb") as f:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+
+
+def open_range(filepath: str, start: int = 0, end=None, unit: str = "bytes"):
+    """
+    Open .json or .json.gz file in binary mode, reading only part of it
+
+    :param filepath: str specifying file path
+    :param start: first byte or line of the range
+    :param end: end (exclusive) of the range, None reads to the end of the file
+    :param unit: "bytes" for byte offsets, or "lines" for line numbers (used for compressed files)
+    """
+    if start == 0 and end is None:
+        return open_file(filepath, mode="rb")
+    return FileRange(open_file(filepath, mode="rb"), start, end, unit)
+
+
+def bytes_read(f) -> int:
+    """
+    Number of bytes of the file on disk consumed so far by a file opened with `open_file` or `open_range`,
+    counting compressed bytes for .gz files and only the bytes after the start of a range
+
+    :param f: binary file-like object
+    """
+    if isinstance(f, FileRange):
+        return bytes_read(f.file) - f.offset
+    if isinstance(f, gzip.GzipFile):
+        return f.fileobj.tell()
+    return f.tell()
+
+
+def input_size(f) -> int:
+    """
+    Number of bytes of the file on disk to be consumed by a file opened with `open_file` or `open_range`
+
+    The size of a compressed line range is not known, the rest of the file after its start is used instead.
+
+    :param f: binary file-like object
+    """
+    if isinstance(f, FileRange):
+        return f.size
+    return os.fstat(f.fileno()).st_size
+
+
+class FileRange:
+    """
+    Read-only file-like object limited to a range of bytes or lines of the underlying binary file
+
+    Line ranges are read by skipping the lines before the range, so compressed files
+    are still decompressed from their beginning.
+    """
+
+    def __init__(self, file, start: int, end, unit: str):
+        self.file = file
+        self.unit = unit
+        if unit == "bytes":
+            self.file.seek(start)
+            self.remaining = None if end is None else end - start
+        else:
+            for _ in range(start):
+                if not self.file.readline():
+                    break
+            self.remaining = None if end is None else end - start
+        self.offset = bytes_read(file)  # bytes of the file on disk before the range
+        file_size = os.fstat(file.fileno()).st_size
+        if unit == "bytes" and end is not None:
+            self.size = min(end, file_size) - start
+        else:
+            self.size = file_size - self.offset
+
+    def read(self, size: int = -1) -> bytes:
+        if self.remaining is not None and self.remaining <= 0:
+            return b""
+
+        if self.unit == "bytes":
+            if self.remaining is not None and (size < 0 or size > self.remaining):
+                size = self.remaining
+            data = self.file.read(size)
+            if self.remaining is not None:
+                self.remaining = self.remaining - len(data)
+            return data
+
+        lines = []
+        read = 0
+        while size < 0 or read < size:
+            if self.remaining is not None and self.remaining <= 0:
+                break
+            line = self.file.readline()
+            if not line:
+                break
+            lines.append(line)
+            read = read + len(line)
+            if self.remaining is not None:
+                self.remaining = self.remaining - 1
+        return b"".join(lines)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Progress:
+    """
+    Progress of reading an input file, measured in bytes of the file on disk so no counting pass is needed
+
+    Reports are made at most once every `interval` seconds, either on a tqdm bar or, for `mode` "json",
+    as one json object per line on stderr, eg.
+    `{"event": "progress", "stage": "Flattening JSON", "file": "in.json", "bytes": 1048576, "total_bytes": 4194304,
+    "records": 2500, ...}`, the stage being desc.
+    The last line has event "done". Mode "none" reports nothing.
+    """
+
+    def __init__(self, name: str, total: int, desc: str, mode: str = "bar", interval: float = 1.0):
+        self.name = name
+        self.total = total
+        self.desc = desc
+        self.mode = mode
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last = self.start
+        self.bar = None
+        if mode == "bar":
+            from tqdm import tqdm
+
+            self.bar = tqdm(total=total, desc=desc, unit="B", unit_scale=True, unit_divisor=1024,
+                            mininterval=interval)
+
+    def update(self, position: int, records: int):
+        """
+        Report the progress if `interval` seconds passed since the last report
+
+        :param position: bytes of the input consumed
+        :param records: records processed
+        """
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report("progress", position, records, now)
+
+    def close(self, position: int, records: int):
+        """
+        Report the final progress, position being the whole input
+        """
+        self.total = position
+        if self.bar is not None:
+            self.bar.total = position
+        self.report("done", position, records, time.monotonic())
+        if self.bar is not None:
+            self.bar.close()
+
+    def report(self, event: str, position: int, records: int, now: float):
+        if self.bar is not None:
+            self.bar.set_postfix_str(f"{records:,} records", refresh=False)
+            self.bar.update(position - self.bar.n)
+        elif self.mode == "json":
+            elapsed = now - self.start
+            rate = position / elapsed if elapsed > 0 else 0.0
+            line = {
+                "event": event,
+                "stage": self.desc,
+                "file": self.name,
+                "bytes": position,
+                "total_bytes": self.total,
+                "percent": round(100 * position / self.total, 1) if self.total else 100.0,
+                "records": records,
+                "elapsed": round(elapsed, 3),
+                "bytes_per_second": round(rate),
+                "eta": round((self.total - position) / rate, 1) if rate and event != "done" else 0.0,
+            }
+            sys.stderr.write(json.dumps(line) + "\n")
+            sys.stderr.flush()
+
+
+class LineReader:
+    """
+    Read-only binary file-like object reading the lines of an iterable one after the other
+
+    Lines are consumed as they are read, so a generator of lines is never held in memory.
+    """
+
+    def __init__(self, lines: Iterable):
+        self.lines = iter(lines)
+        self.pending = b""  # read from the lines but not returned yet
+        self.count = 0  # number of lines read
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = [self.pending]
+        read = len(self.pending)
+        while size < 0 or read < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            if not line.endswith(b"\n"):
+                line = line + b"\n"
+            chunks.append(line)
+            read = read + len(line)
+            self.count = self.count + 1
+
+        data = b"".join(chunks)
+        if size < 0 or len(data) <= size:
+            self.pending = b""
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+
+class SparseRow:
+    """
+    Read-only row of a table stored as a dict of its filled fields (column index -> value)
+
+    Behaves as a sequence of `size` values, the fields not in `cells` being None.
+    `to_list` gives the full list of values.
+    """
+    __slots__ = ('size', 'cells')
+
+    def __init__(self, size: int, cells: dict):
+        self.size = size
+        self.cells = cells
+
+    def to_list(self) -> list:
+        row = [None] * self.size
+        for index, value in self.cells.items():
+            row[index] = value
+        return row
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.to_list()[index]
+        if index < 0:
+            index = index + self.size
+        if not 0 <= index < self.size:
+            raise IndexError("row index out of range")
+        return self.cells.get(index)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+
 class Row:
     """
+    Values of one table for the record being parsed
+
+    Only the filled fields are kept, so the cost of a row depends on its values and not on the table width.
     """
 
     def __init__(self, size: int, col_lookup: dict):
-        self.row = [None] * size
+        self.cells = {}
         self.col_lookup = col_lookup
         self.size = size
 
     def set_value(self, column, value):
-        index = self.col_lookup[column]
-        self.row[index] = value
+        self.cells[self.col_lookup[column]] = value
 
     def get_value(self, column):
-        index = self.col_lookup[column]
-        return self.row[index]
+        return self.cells.get(self.col_lookup[column])
 
     def get_row(self):
-        return self.row
+        return SparseRow(self.size, self.cells)
+
+    def take_row(self):
+        """
+        Get the row and start a new empty one
+        """
+        row = SparseRow(self.size, self.cells)
+        self.cells = {}
+        return row
+
+    def reset(self):
+        self.cells = {}
 
     def __len__(self):
         return self.size
@@ -44,8 +327,10 @@ class RowBuffer:
     Helper class for accumulating rows from json flattening before writing to file
     A defaultdict mapping tables to a list of parsed rows
     """
-    collector = defaultdict(Queue)
-    size = 0  # total number of rows being kept in collector
+
+    def __init__(self):
+        self.collector = defaultdict(list)
+        self.size = 0  # total number of rows being kept in collector
 
     def append(self, table, row):
         """
@@ -54,8 +339,8 @@ class RowBuffer:
         :param row:
         :return:
         """
-        self.collector[table].put_nowait(row)
-        self.inc_size()
+        self.collector[table].append(row)
+        self.size = self.size + 1
 
     def get_rows(self, table):
         """
@@ -63,7 +348,7 @@ class RowBuffer:
         :param table:
         :return:
         """
-        return self.collector[table].queue
+        return self.collector[table]
 
     def get_tables(self):
         """
@@ -86,10 +371,189 @@ class RowBuffer:
         self.size = self.size + 1
 
     def reset(self):
-        self.collector = defaultdict(Queue)
+        self.collector = defaultdict(list)
         self.size = 0
 
 
+class DuplicateIdentifierError(ValueError):
+    """
+    Several records share the same identifier values
+    """
+
+
+class RecordHashes:
+    """
+    On-disk store of a hash of every record's flattened content, keyed by the record's identifier values
+
+    Used to only output the records that are new or changed since the previous run.
+    The store is a gzip compressed text file with one `<hash>\t<identifier values as json>` line per record.
+    The hash covers the sorted (table, column name, value) of the filled fields other than the identifiers,
+    so it does not change when columns are added to the mappings.
+    """
+
+    def __init__(self, path, mappings: dict, identifiers: Iterable = ()):
+        self.path = str(path)
+        self.columns = [list(columns) for columns in mappings.values()]  # column names of every table
+        self.tables = list(mappings)
+        self.identifiers = set(identifiers)
+        self.previous = {}
+        self.current = {}
+        self.changed = 0
+        self.unchanged = 0
+
+        if os.path.exists(self.path):
+            with gzip.open(self.path, mode="rt", encoding="utf-8") as f:
+                for line in f:
+                    digest, key = line.rstrip("\n").split("\t", 1)
+                    self.previous[key] = digest
+
+    def is_changed(self, id_values: list, rows: list) -> bool:
+        """
+        Record the hash of a record and tell whether it is new or differs from the previous run
+
+        :param id_values: identifier values of the record
+        :param rows: `SparseRow` of the record for every table, in the order of mappings
+        :raises DuplicateIdentifierError: if a previous record of this run had the same identifier values
+        """
+        key = json.dumps(id_values)
+        if key in self.current:
+            raise DuplicateIdentifierError(f"Several records have the identifier values {key}, "
+                                           f"records must have unique identifiers to be tracked between runs")
+
+        fields = []
+        for table, columns, row in zip(self.tables, self.columns, rows):
+            for index, value in row.cells.items():
+                if columns[index] not in self.identifiers:
+                    fields.append((table, columns[index], value))
+        fields.sort(key=lambda field: (field[0], field[1]))
+        digest = hashlib.blake2b(repr(fields).encode("utf-8"), digest_size=8).hexdigest()
+        self.current[key] = digest
+
+        if self.previous.get(key) == digest:
+            self.unchanged = self.unchanged + 1
+            return False
+        self.changed = self.changed + 1
+        return True
+
+    def keep(self, id_values: list):
+        """
+        Keep the hash of the previous run for a record that was not compared, eg. skipped by `--where`,
+        so it is neither reported as deleted nor dropped from the store
+
+        :param id_values: identifier values of the record
+        :raises DuplicateIdentifierError: if a previous record of this run had the same identifier values
+        """
+        key = json.dumps(id_values)
+        if key in self.current:
+            raise DuplicateIdentifierError(f"Several records have the identifier values {key}, "
+                                           f"records must have unique identifiers to be tracked between runs")
+        if key in self.previous:
+            self.current[key] = self.previous[key]
+
+    def deleted(self) -> list:
+        """
+        Get the identifier values of the records of the previous run that were not seen in this run
+        """
+        return [json.loads(key) for key in self.previous if key not in self.current]
+
+    def save(self):
+        """
+        Replace the store with the hashes of this run
+        """
+        tmp_path = self.path + ".tmp"
+        with gzip.open(tmp_path, mode="wt", encoding="utf-8") as f:
+            for key, digest in self.current.items():
+                f.write(f"{digest}\t{key}\n")
+        os.replace(tmp_path, self.path)
+
+
+class _LineCollector:
+    """
+    File-like object appending every written string to a list
+    """
+    __slots__ = ('write',)
+
+    def __init__(self, lines: list):
+        self.write = lines.append
+
+
+class CSVEncoder:
+    """
+    Writer producing the same output as `csv.writer` with the default dialect, specialised for wide rows
+    that are mostly None
+
+    A `SparseRow` is written from its filled fields, the runs of empty fields between them being written
+    as runs of commas without visiting every field. Runs of dense rows, rows with a value that needs
+    quoting and plain lists are written by a single `csv.writer.writerows` call, which keeps the output
+    identical. Each call to `writerows` makes a single `write` to the file.
+
+    :param header: column names, encoded once and written by `writeheader`
+    """
+
+    def __init__(self, file, header: list = None):
+        self.file = file
+        self.lines = []  # encoded lines of the rows being written
+        self.writer = csv.writer(_LineCollector(self.lines))
+        self.lineterminator = self.writer.dialect.lineterminator
+        self.header = None if header is None else self.encode_rows([header])
+
+    def encode_sparse(self, row: SparseRow):
+        """
+        Encode a row from its filled fields, None if the csv module must quote a value
+        """
+        cells = row.cells
+        parts = []
+        pos = 0  # index of the field the commas written so far lead to
+        for i in sorted(cells):
+            value = cells[i]
+            parts.append(',' * (i - pos))
+            pos = i
+            if value.__class__ is str:
+                parts.append(value)
+            elif value is not None:
+                parts.append(str(value))
+        parts.append(',' * (len(row) - 1 - pos))
+        line = ''.join(parts)
+
+        # a value containing a delimiter, quote or line break needs quoting
+        if line.count(',') != len(row) - 1 or '"' in line or '\n' in line or '\r' in line:
+            return None
+        return line + self.lineterminator
+
+    def encode_rows(self, rows) -> str:
+        """
+        Encode rows with their line terminators
+        """
+        lines = self.lines  # the csv module appends the lines of dense rows to the same list
+        dense = []  # run of rows since the last sparse row, written by the csv module together
+        for row in rows:
+            if row.__class__ is SparseRow:
+                if row.size > 1 and len(row.cells) * 8 < row.size:
+                    line = self.encode_sparse(row)
+                    if line is not None:
+                        if dense:
+                            self.writer.writerows(dense)
+                            dense = []
+                        lines.append(line)
+                        continue
+                row = row.to_list()
+            dense.append(row)
+        if dense:
+            self.writer.writerows(dense)
+        encoded = ''.join(lines)
+        lines.clear()
+        return encoded
+
+    def writeheader(self):
+        self.file.write(self.header)
+
+    def writerow(self, row):
+        self.file.write(self.encode_rows([row]))
+
+    def writerows(self, rows):
+        self.file.write(self.encode_rows(rows))
+
+
 class FileHandler:
     """
     Represents a dict of all CSV files with methods to open and close all
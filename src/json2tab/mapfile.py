@@ -0,0 +1,288 @@
+import json
+import mmap
+import struct
+import sys
+from array import array
+from collections.abc import Mapping as MappingABC
+from typing import Iterable
+
+MAGIC = b"J2TMAP\x00\x00"
+VERSION = 2
+EXTENSION = ".j2tmap"  # extension of binary mapping files
+
+# All integers are little-endian. The file is laid out as:
+#   header     magic, version, number of tables, offset of the string table, offset of the table directory
+#   strings    number of strings, size of the blob, (strings + 1) offsets (u64) of every string in the blob,
+#              utf-8 blob of every string
+#   directory  per table: number of columns, offset of the table section; then the size and NUL separated
+#              blob of the table names
+#   tables     per table: count, nulls (u64 arrays), name string, types string, max_length (u32 arrays) of every
+#              column
+# Column names and type lists ("string,integer") are interned, so identifiers repeated in every table
+# are stored once. The offsets let a table decode only its own strings.
+# Path components of the column names are not stored: they are the names split on ".", and the parser
+# matches values to columns by their dotted names.
+HEADER = struct.Struct("<8sIIQQ")
+STRINGS_HEADER = struct.Struct("<IQ")
+DIRECTORY_ENTRY = struct.Struct("<IQ")
+NO_STATS = 0xFFFFFFFF  # types string of a column without statistics
+
+
+def is_binary(path) -> bool:
+    """
+    Whether path is a binary mapping file, judging by its extension
+    """
+    return str(path).endswith(EXTENSION)
+
+
+def _pack(typecode: str, values) -> bytes:
+    """
+    Little-endian bytes of an array of unsigned integers, typecode "I" (32 bits) or "Q" (64 bits)
+    """
+    values = array(typecode, values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def _unpack(typecode: str, data) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def _join(strings: list) -> bytes:
+    for string in strings:
+        if "\0" in string:
+            raise ValueError(f"Key {string!r} contains a NUL character and cannot be stored in a binary mapping file")
+    return "\0".join(strings).encode("utf-8")
+
+
+def write_mappings(mappings: dict, path):
+    """
+    Write mappings to a binary mapping file
+
+    :param mappings: mappings, see `json2tab.mapping.Mapping`
+    :param path: path of the file to write
+    """
+    strings = {}  # string -> id, in order of first use
+
+    sections = []
+    for columns in mappings.values():
+        counts, nulls, names, types, max_lengths = [], [], [], [], []
+        for column, stats in columns.items():
+            names.append(strings.setdefault(column, len(strings)))
+            if stats is None:
+                counts.append(0)
+                nulls.append(0)
+                types.append(NO_STATS)
+                max_lengths.append(0)
+            else:
+                counts.append(stats["count"])
+                nulls.append(stats["nulls"])
+                types.append(strings.setdefault(",".join(stats["types"]), len(strings)))
+                max_lengths.append(stats["max_length"])
+        section = _pack("Q", counts) + _pack("Q", nulls) + _pack("I", names) + _pack("I", types) \
+            + _pack("I", max_lengths)
+        sections.append(section + b"\0" * (-len(section) % 8))
+
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = [0]
+    for string in encoded:
+        offsets.append(offsets[-1] + len(string))
+    string_table = STRINGS_HEADER.pack(len(strings), offsets[-1]) + _pack("Q", offsets) + b"".join(encoded)
+    string_table = string_table + b"\0" * (-len(string_table) % 8)
+
+    names = _join(list(mappings))
+    strings_offset = HEADER.size
+    directory_offset = strings_offset + len(string_table)
+    directory_size = DIRECTORY_ENTRY.size * len(mappings) + 8 + len(names)
+    table_offset = directory_offset + directory_size + (-directory_size % 8)
+
+    entries = []
+    for columns, section in zip(mappings.values(), sections):
+        entries.append(DIRECTORY_ENTRY.pack(len(columns), table_offset))
+        table_offset = table_offset + len(section)
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(mappings), strings_offset, directory_offset))
+        f.write(string_table)
+        f.write(b"".join(entries) + struct.pack("<Q", len(names)) + names + b"\0" * (-directory_size % 8))
+        for section in sections:
+            f.write(section)
+
+
+class MappingFile(MappingABC):
+    """
+    Read-only mappings backed by a memory-mapped binary mapping file
+
+    Opening the file only reads its header and table directory, so `table_names` is cheap.
+    Each table is decoded the first time it is accessed, along with the interned strings it uses.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, "rb") as f:
+            try:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise ValueError(f"{self.path} is not a binary mapping file")
+
+        try:
+            if len(self.buffer) < HEADER.size or self.buffer[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{self.path} is not a binary mapping file")
+            _, version, num_tables, self.strings_offset, directory_offset = HEADER.unpack_from(self.buffer, 0)
+            if version != VERSION:
+                raise ValueError(f"Unsupported mapping file version {version} in {self.path}")
+
+            names_offset = directory_offset + DIRECTORY_ENTRY.size * num_tables
+            entries = list(DIRECTORY_ENTRY.iter_unpack(self.read(directory_offset, names_offset)))
+            (names_size,) = struct.unpack("<Q", self.read(names_offset, names_offset + 8))
+            names = self.read(names_offset + 8, names_offset + 8 + names_size).decode("utf-8").split("\0")
+
+            self.num_strings, blob_size = STRINGS_HEADER.unpack(
+                self.read(self.strings_offset, self.strings_offset + STRINGS_HEADER.size))
+            self.offsets_offset = self.strings_offset + STRINGS_HEADER.size
+            self.blob_offset = self.offsets_offset + 8 * (self.num_strings + 1)
+            self.read(self.blob_offset + blob_size - 1, self.blob_offset + blob_size)  # raises if truncated
+        except (struct.error, UnicodeDecodeError) as e:
+            self.buffer.close()
+            raise ValueError(f"{self.path} is not a valid binary mapping file: {e}")
+        except ValueError:
+            self.buffer.close()
+            raise
+        self.directory = dict(zip(names, entries))  # table -> (number of columns, offset of its section)
+
+        self.strings = {}  # interned strings decoded so far, by id
+        self.tables = {}  # decoded tables
+
+    def read(self, start: int, end: int) -> bytes:
+        """
+        Bytes of the file from start to end
+
+        :raises ValueError: if the file ends before end
+        """
+        if end > len(self.buffer):
+            raise ValueError(f"{self.path} is truncated, {end:,} bytes expected but it has {len(self.buffer):,}")
+        return self.buffer[start:end]
+
+    def table_names(self) -> list:
+        return list(self.directory)
+
+    def string(self, string_id: int) -> str:
+        """
+        Interned string with id string_id, decoded on first use
+        """
+        string = self.strings.get(string_id)
+        if string is None:
+            if string_id >= self.num_strings:
+                raise ValueError(f"{self.path} is not a valid binary mapping file: unknown string {string_id}")
+            position = self.offsets_offset + 8 * string_id
+            start, end = struct.unpack("<QQ", self.read(position, position + 16))
+            try:
+                string = self.read(self.blob_offset + start, self.blob_offset + end).decode("utf-8")
+            except UnicodeDecodeError as e:
+                raise ValueError(f"{self.path} is not a valid binary mapping file: {e}")
+            self.strings[string_id] = string
+        return string
+
+    def read_arrays(self, table: str) -> tuple:
+        """
+        Column arrays of table: counts, nulls, name and types string ids and max lengths
+        """
+        num_columns, offset = self.directory[table]
+        arrays = []
+        for typecode in ("Q", "Q", "I", "I", "I"):
+            size = num_columns * (8 if typecode == "Q" else 4)
+            arrays.append(_unpack(typecode, self.read(offset, offset + size)))
+            offset = offset + size
+        return tuple(arrays)
+
+    def columns(self, table: str) -> list:
+        """
+        Column names of table, in output order
+        """
+        return [self.string(i) for i in self.read_arrays(table)[2]]
+
+    def __getitem__(self, table: str) -> dict:
+        columns = self.tables.get(table)
+        if columns is None:
+            counts, nulls, names, types, max_lengths = self.read_arrays(table)
+            type_lists = {}  # decoded type lists by string id
+            columns = {}
+            for name_id, count, null, types_id, max_length in zip(names, counts, nulls, types, max_lengths):
+                column = self.string(name_id)
+                if types_id == NO_STATS:
+                    columns[column] = None
+                    continue
+                if types_id not in type_lists:
+                    types_string = self.string(types_id)
+                    type_lists[types_id] = types_string.split(",") if types_string else []
+                columns[column] = {"types": list(type_lists[types_id]), "count": count, "nulls": null,
+                                   "max_length": max_length}
+            self.tables[table] = columns
+        return columns
+
+    def __iter__(self):
+        return iter(self.directory)
+
+    def __len__(self):
+        return len(self.directory)
+
+    def to_dict(self) -> dict:
+        """
+        Decode every table into plain mappings
+        """
+        return {table: self[table] for table in self.directory}
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_mappings(path, tables: Iterable = None) -> dict:
+    """
+    Load a json or binary mapping file
+
+    :param path: mapping file path, binary files have the extension `EXTENSION`
+    :param tables: only load these tables, only decoding them from binary files. Defaults to every table
+    :return: mappings, in the table order of the file
+    """
+    if is_binary(path):
+        with MappingFile(path) as mapping_file:
+            if tables is None:
+                return mapping_file.to_dict()
+            return {table: mapping_file[table] for table in mapping_file if table in tables}
+    with open(path, "r") as f:
+        mappings = json.load(f)
+    if tables is None:
+        return mappings
+    return {table: mappings[table] for table in mappings if table in tables}
+
+
+def save_mappings(mappings: dict, path):
+    """
+    Save mappings to a json or binary mapping file depending on the extension of path
+    """
+    if is_binary(path):
+        write_mappings(mappings, path)
+    else:
+        with open(path, "w") as f:
+            json.dump(mappings, f)
+
+
+def read_table_names(path) -> list:
+    """
+    Names of the tables in a mapping file, reading only the directory of binary files
+    """
+    if is_binary(path):
+        with MappingFile(path) as mapping_file:
+            return mapping_file.table_names()
+    return list(load_mappings(path))
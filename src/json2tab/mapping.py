@@ -1,15 +1,25 @@
+import copy
+import random
 from typing import Iterable
 
 from json2tab import Config
 from json2tab.utils import parse, open_file
-from ijson import IncompleteJSONError
+from json2tab.helpers import LineReader, Progress, bytes_read, input_size
 import click
 
-from tqdm import tqdm
+PROGRESS_RECORDS = 1000  # records read between two progress updates, each asks the file for its position
 
 
 class Mapping:
+    """
+    Mappings are a dict of tables, each a dict of its columns in output order.
+    The value of a column is None or the statistics observed for it in the json file:
+    `{"types": [...], "count": n, "nulls": n, "max_length": n}` where types are json types
+    ("string", "integer", "number", "boolean"), count is the number of values, nulls the number of records
+    without a value and max_length the length of the longest string value.
+    """
     total_count_json = 0  # total count of json lines in file
+    OVERFLOW_COLUMN = "_overflow"  # column holding leaves missing from a sampled mapping
 
     @staticmethod
     def create_mappings(select_tables: Iterable, config: Config) -> dict:
@@ -22,6 +32,8 @@ class Mapping:
         :param select_tables: tables to output
         :return: mappings
         """
+        from ijson import IncompleteJSONError, JSONError
+
         mappings = {}
 
         with open_file(config.json_file, mode="r") as f:
@@ -40,25 +52,249 @@ class Mapping:
                 click.echo(f"ijson.IncompleteJSONError {e}", err=True)
                 pass
 
-            # Add identifiers (e.g. factId and rollNumber) to each table
-            for table in mappings:
-                for identifier in config.identifiers:
-                    mappings[table][identifier] = None
+        # Add identifiers (e.g. factId and rollNumber) to each table
+        for table in mappings:
+            for identifier in config.identifiers:
+                mappings[table][identifier] = None
 
-            # Second pass: add all column names to mappings with default values
-            # This pass goes through the entire json file to collect all possible columns
+        # Second pass: add all column names to mappings with default values
+        # This pass goes through the entire json file (or a sample of its records) to collect all possible columns
+        if config.sample_size or config.sample_fraction:
+            sample = LineReader(Mapping.sample_records(config))
             try:
-                progress = tqdm(desc="Creating mappings", unit=" lines")
-                for (base_prefix, prefix, event, value) in parse(f, multiple_values=True, use_float=True):
-                    if event == "string" or event == "number" or event == "boolean":
-                        # find table that matches the prefix and add value if value is an external node
-                        if base_prefix in select_tables and base_prefix not in config.identifiers:
-                            mappings[base_prefix][prefix] = None
-                    elif prefix == '' and event == 'end_map' and value is None:
-                        progress.update(1)
-                        Mapping.total_count_json = Mapping.total_count_json + 1
-            except IncompleteJSONError as e:
-                click.echo(f"ijson.IncompleteJSONError {e}", err=True)
-                pass
+                num_records = Mapping.collect_columns(sample, select_tables, config, mappings)
+            except JSONError:
+                num_records = None
+            if num_records != sample.count:
+                option_name = '--sample' if config.sample_size else '--sample-fraction'
+                raise click.exceptions.BadOptionUsage(
+                    option_name=option_name,
+                    message=f"Invalid value for '{option_name}': the sampled lines of {config.json_file} "
+                            f"are not complete json records. Sampling requires one json per line.")
+
+            # leaves that were not sampled are kept in an overflow column instead of being dropped
+            for table in mappings:
+                mappings[table][Mapping.OVERFLOW_COLUMN] = None
+        else:
+            with open_file(config.json_file, mode="rb") as f:
+                progress = Progress(config.json_file, input_size(f), "Creating mappings", config.progress,
+                                    config.progress_interval)
+                num_records = Mapping.collect_columns(f, select_tables, config, mappings, count=True,
+                                                      progress=progress)
+                progress.close(bytes_read(f), num_records)
 
         return mappings
+
+    @staticmethod
+    def create_mappings_multi(select_tables: Iterable, config: Config, json_files: list, max_workers=None) -> dict:
+        """
+        Creates one set of mappings covering every file in json_files
+
+        The mappings of each file are created in parallel processes and merged in file order,
+        so every output file shares the same headers.
+
+        :param select_tables: tables to output
+        :param config: configured parameters from user input
+        :param json_files: json file paths
+        :param max_workers: number of processes, defaults to the number of processors
+        :return: mappings
+        """
+        import concurrent.futures
+
+        configs = []
+        for json_file in json_files:
+            file_config = copy.copy(config)
+            file_config.json_file = json_file
+            configs.append(file_config)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_create_file_mappings, [select_tables] * len(configs), configs))
+
+        for _, count in results:
+            Mapping.total_count_json = Mapping.total_count_json + count
+
+        return Mapping.merge_mappings([mappings for mappings, _ in results])
+
+    @staticmethod
+    def merge_mappings(mappings_list: Iterable) -> dict:
+        """
+        Union of several mappings, keeping the column order of first appearance
+
+        :param mappings_list: mappings to merge
+        :return: merged mappings
+        """
+        merged = {}
+        num_records = 0
+        for mappings in mappings_list:
+            num_records = num_records + Mapping.count_records(mappings)
+            for table in mappings:
+                columns = merged.setdefault(table, {})
+                for column, stats in mappings[table].items():
+                    columns[column] = Mapping.merge_stats(columns.get(column), stats)
+
+        # records of files where a column is missing count as nulls of that column
+        for table in merged:
+            for stats in merged[table].values():
+                if stats is not None:
+                    stats["nulls"] = num_records - stats["count"]
+
+        # the overflow column always stays last
+        for table in merged:
+            if Mapping.OVERFLOW_COLUMN in merged[table]:
+                merged[table][Mapping.OVERFLOW_COLUMN] = merged[table].pop(Mapping.OVERFLOW_COLUMN)
+
+        return merged
+
+    @staticmethod
+    def merge_stats(stats: dict, other: dict) -> dict:
+        """
+        Combine the statistics of the same column from two mappings into a new dict
+        """
+        if stats is None or other is None:
+            return dict(stats or other) if (stats or other) else None
+        return {
+            "types": stats["types"] + [t for t in other["types"] if t not in stats["types"]],
+            "count": stats["count"] + other["count"],
+            "nulls": stats["nulls"] + other["nulls"],
+            "max_length": max(stats["max_length"], other["max_length"]),
+        }
+
+    @staticmethod
+    def count_records(mappings: dict) -> int:
+        """
+        Number of records the statistics of mappings were observed on, 0 if mappings have no statistics
+        """
+        for table in mappings:
+            for stats in mappings[table].values():
+                if stats is not None:
+                    return stats["count"] + stats["nulls"]
+        return 0
+
+    @staticmethod
+    def collect_columns(f, select_tables: Iterable, config: Config, mappings: dict, count: bool = False,
+                        progress: Progress = None):
+        """
+        Add the column name of every leaf found in `f` to its table in mappings,
+        along with the statistics of its values
+
+        :param f: file-like object of json records
+        :param select_tables: tables to output
+        :param config: configured parameters from user input
+        :param mappings: mappings to add columns to
+        :param count: count records into `Mapping.total_count_json`
+        :param progress: progress of reading f, updated every `PROGRESS_RECORDS` records
+        :return: number of records read
+        """
+        from ijson import IncompleteJSONError
+
+        id_stats = {}  # identifier columns are shared by every table
+        num_records = 0
+
+        try:
+            for (base_prefix, prefix, event, value) in parse(f, multiple_values=True, use_float=True):
+                if event == "string" or event == "number" or event == "boolean":
+                    # find table that matches the prefix and add value if value is an external node
+                    if base_prefix in select_tables and base_prefix not in config.identifiers:
+                        columns = mappings[base_prefix]
+                    elif base_prefix in config.identifiers:
+                        columns = id_stats
+                    else:
+                        continue
+
+                    stats = columns.get(prefix)
+                    if stats is None:
+                        stats = {"types": [], "count": 0, "nulls": 0, "max_length": 0}
+                        columns[prefix] = stats
+
+                    if event == "string":
+                        json_type = "string"
+                        if len(value) > stats["max_length"]:
+                            stats["max_length"] = len(value)
+                    elif event == "boolean":
+                        json_type = "boolean"
+                    elif isinstance(value, int):
+                        json_type = "integer"
+                    else:
+                        json_type = "number"
+                    if json_type not in stats["types"]:
+                        stats["types"].append(json_type)
+                    stats["count"] = stats["count"] + 1
+
+                elif prefix == '' and event == 'end_map' and value is None:
+                    num_records = num_records + 1
+                    if count:
+                        Mapping.total_count_json = Mapping.total_count_json + 1
+                    if progress is not None and num_records % PROGRESS_RECORDS == 0:
+                        progress.update(bytes_read(f), num_records)
+        except IncompleteJSONError as e:
+            click.echo(f"ijson.IncompleteJSONError {e}", err=True)
+            pass
+
+        for table in mappings:
+            for identifier in config.identifiers:
+                if identifier in id_stats:
+                    mappings[table][identifier] = id_stats[identifier]
+            for stats in mappings[table].values():
+                if stats is not None:
+                    stats["nulls"] = num_records - stats["count"]
+
+        return num_records
+
+    @staticmethod
+    def sample_records(config: Config) -> Iterable:
+        """
+        Select a random sample of the records in the json file without parsing them
+
+        Records are expected one per line (newline-delimited json).
+        With `config.sample_size` a fixed number of records is kept using reservoir sampling,
+        otherwise each record is kept with probability `config.sample_fraction` and yielded as soon as it is read,
+        so the sample is never held in memory.
+        Every line is counted into `Mapping.total_count_json`.
+
+        :param config: configured parameters from user input
+        :return: generator of the sampled lines, in file order
+        """
+        rng = random.Random()
+        reservoir = []  # (line number, record) pairs
+        seen = 0
+        sampled = 0
+
+        with open_file(config.json_file, mode="rb") as f:
+            progress = Progress(config.json_file, input_size(f), "Sampling records", config.progress,
+                                config.progress_interval)
+            for line in f:
+                if not line.strip():
+                    continue
+                if seen % PROGRESS_RECORDS == 0:
+                    progress.update(bytes_read(f), seen)
+
+                if config.sample_size:
+                    if seen < config.sample_size:
+                        reservoir.append((seen, line))
+                    else:
+                        i = rng.randrange(seen + 1)
+                        if i < config.sample_size:
+                            reservoir[i] = (seen, line)
+                elif rng.random() < config.sample_fraction:
+                    sampled = sampled + 1
+                    yield line
+                seen = seen + 1
+            progress.close(bytes_read(f), seen)
+
+        Mapping.total_count_json = Mapping.total_count_json + seen
+        click.echo(f"Sampled {sampled or len(reservoir):,} of {seen:,} records for mappings")
+
+        reservoir.sort(key=lambda pair: pair[0])
+        for _, line in reservoir:
+            yield line
+
+
+def _create_file_mappings(select_tables: Iterable, config: Config) -> tuple:
+    """
+    Process pool worker creating the mappings of a single file
+
+    :return: mappings and the number of json lines counted
+    """
+    Mapping.total_count_json = 0
+    mappings = Mapping.create_mappings(select_tables, config)
+    return mappings, Mapping.total_count_json
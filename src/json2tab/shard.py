@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from json2tab.helpers import open_file, concat_files
+
+MANIFEST_VERSION = 2
+FINGERPRINT_SIZE = 1024 * 1024  # bytes hashed at the start and at the end of the input file
+
+
+def fingerprint(json_file: str) -> str:
+    """
+    Checksum identifying the content of json_file, hashing its size and its first and last megabyte
+
+    Compressed files are hashed as stored, without decompressing them.
+
+    :param json_file: input json file path
+    :return: hex digest
+    """
+    size = os.path.getsize(json_file)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(json_file, mode="rb") as f:
+        digest.update(f.read(FINGERPRINT_SIZE))
+        if size > FINGERPRINT_SIZE:
+            f.seek(max(size - FINGERPRINT_SIZE, FINGERPRINT_SIZE))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def find_shard_ranges(json_file: str, num_shards: int) -> tuple:
+    """
+    Split json_file into record-aligned ranges of about equal size
+
+    Uncompressed files are split on byte offsets moved forward to the next line start.
+    Compressed files cannot be read from the middle, so they are split on line numbers instead.
+
+    :param json_file: newline-delimited json file path
+    :param num_shards: number of ranges wanted
+    :return: unit of the ranges ("bytes" or "lines") and list of [start, end] ranges
+    """
+    if json_file.endswith(".gz"):
+        with open_file(json_file, mode="rb") as f:
+            num_lines = sum(1 for _ in f)
+        boundaries = [num_lines * i // num_shards for i in range(num_shards)] + [num_lines]
+        unit = "lines"
+    else:
+        size = os.path.getsize(json_file)
+        boundaries = [0]
+        with open(json_file, mode="rb") as f:
+            for i in range(1, num_shards):
+                f.seek(max(size * i // num_shards - 1, boundaries[-1]))
+                f.readline()  # move to the start of the next record
+                boundaries.append(min(f.tell(), size))
+        boundaries.append(size)
+        unit = "bytes"
+
+    ranges = [[start, end] for start, end in zip(boundaries, boundaries[1:]) if end > start]
+    return unit, ranges
+
+
+def write_manifest(manifest_path, json_file: str, name: str, mapping_file: str, tables: list, identifiers: list,
+                   num_shards: int, extension: str, chunk_size: int) -> dict:
+    """
+    Write the manifest describing how json_file is split into shards
+
+    :param manifest_path: path of the manifest json to write
+    :param json_file: input json file path
+    :param name: prefix of the output file names
+    :param mapping_file: mappings json file name, relative to the manifest directory
+    :param tables: tables to output
+    :param identifiers: identifier keys added to every table
+    :param num_shards: number of shards wanted
+    :param extension: extension of the output files, .csv or .csv.gz
+    :param chunk_size: number of rows to keep in memory before writing
+    :return: manifest
+    """
+    unit, ranges = find_shard_ranges(json_file, num_shards)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "input": os.path.abspath(json_file),
+        "input_size": os.path.getsize(json_file),
+        "input_fingerprint": fingerprint(json_file),
+        "name": name,
+        "mapping_file": mapping_file,
+        "tables": list(tables),
+        "identifiers": list(identifiers),
+        "extension": extension,
+        "chunk_size": chunk_size,
+        "unit": unit,
+        "shards": ranges,
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def read_manifest(manifest_path) -> dict:
+    """
+    Load a manifest written by `write_manifest`
+
+    :param manifest_path: manifest json file path
+    :return: manifest
+    """
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version {manifest.get('version')} in {manifest_path}")
+    return manifest
+
+
+def check_input(manifest: dict, json_file: str):
+    """
+    Check that json_file is the input the manifest was planned on, the shard ranges being only valid for it
+
+    :param manifest: manifest of the sharded run
+    :param json_file: input json file path
+    :raises ValueError: if the size or fingerprint of json_file differ from the planned input
+    """
+    size = os.path.getsize(json_file)
+    if size != manifest["input_size"]:
+        raise ValueError(f"{json_file} has {size:,} bytes but the planned input {manifest['input']} "
+                         f"had {manifest['input_size']:,} bytes")
+    if fingerprint(json_file) != manifest["input_fingerprint"]:
+        raise ValueError(f"{json_file} does not have the same content as the planned input {manifest['input']}")
+
+
+def part_name(manifest: dict, shard: int) -> str:
+    """
+    Prefix of the output file names of one shard
+    """
+    return f"{manifest['name']}_part{shard:05d}"
+
+
+def merge_parts(manifest: dict, parts_dir, out_dir, remove_parts: bool = False) -> list:
+    """
+    Concatenate the outputs of every shard, in order, into one file per table
+
+    Only the first shard writes the header row, so the parts can be concatenated byte for byte.
+
+    :param manifest: manifest of the sharded run
+    :param parts_dir: directory holding the outputs of every shard
+    :param out_dir: directory to write the merged files to
+    :param remove_parts: delete the shard outputs once merged
+    :return: paths of the merged files
+    """
+    extension = manifest["extension"]
+    merged = []
+    for table in manifest["tables"]:
+        parts = [Path(parts_dir) / f"{part_name(manifest, k)}_{table}{extension}"
+                 for k in range(len(manifest["shards"]))]
+        missing = [str(part) for part in parts if not part.exists()]
+        if missing:
+            raise FileNotFoundError(f"Missing shard outputs: {', '.join(missing)}")
+
+        destination = Path(out_dir) / f"{manifest['name']}_{table}{extension}"
+        concat_files(parts, destination)
+        merged.append(destination)
+
+        if remove_parts:
+            for part in parts:
+                os.remove(part)
+
+    return merged
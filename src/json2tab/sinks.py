@@ -0,0 +1,252 @@
+import abc
+import asyncio
+import json
+import threading
+from pathlib import Path
+
+from json2tab.helpers import CSVEncoder, FileHandler
+
+# pragmas for a single writer bulk load. The write-ahead log is kept so that a crash during the load
+# cannot corrupt other tables of the database, only the last transactions may be lost.
+# The previous journal mode of the database is restored when the load is done.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA locking_mode = EXCLUSIVE",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -262144",  # 256 MB
+)
+DEFAULT_MAX_COLUMNS = 2000  # SQLITE_MAX_COLUMN of default SQLite builds
+EXTRA_COLUMN = "_extra"  # json column holding the values of the columns of a table beyond the column limit
+
+
+def quote_identifier(name: str) -> str:
+    """
+    Quote a table or column name for use in an SQL statement
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sql_type(stats) -> str:
+    """
+    SQLite column type for the statistics of a column in mappings
+
+    :param stats: column statistics from mappings, or None when unknown
+    """
+    if not stats or not stats["types"]:
+        return "TEXT"
+    types = set(stats["types"])
+    if types <= {"integer", "boolean"}:
+        return "INTEGER"
+    if types <= {"integer", "number"}:
+        return "REAL"
+    return "TEXT"
+
+
+def unique_names(names: list) -> list:
+    """
+    Make names unique for SQLite, which compares table and column names case-insensitively
+
+    A name equal to a previous one apart from case gets a numeric suffix, eg. ["a.Name", "a.name"] ->
+    ["a.Name", "a.name_2"].
+    """
+    seen = {name.lower() for name in names}
+    used = set()
+    result = []
+    for name in names:
+        unique = name
+        if name.lower() in used:
+            n = 2
+            while f"{name}_{n}".lower() in used or f"{name}_{n}".lower() in seen:
+                n = n + 1
+            unique = f"{name}_{n}"
+        used.add(unique.lower())
+        result.append(unique)
+    return result
+
+
+def split_columns(columns: dict, max_columns: int) -> tuple:
+    """
+    Choose the columns of a table stored as SQL columns when the table has more than max_columns columns
+
+    The identifiers and the most filled columns are kept, in their order in mappings, and the values of
+    the others are stored in the json column `EXTRA_COLUMN`.
+
+    :param columns: columns of the table in mappings, with their statistics
+    :param max_columns: maximum number of columns of an SQLite table
+    :return: indices of the kept columns, indices of the columns stored in `EXTRA_COLUMN`
+    """
+    if len(columns) <= max_columns:
+        return list(range(len(columns))), []
+
+    stats = list(columns.values())
+    # columns without statistics (identifiers) first, then by number of values
+    ranked = sorted(range(len(stats)), key=lambda i: -1 if stats[i] is None else -stats[i]["count"])
+    kept = sorted(ranked[:max_columns - 1])
+    extra = sorted(ranked[max_columns - 1:])
+    return kept, extra
+
+
+class SQLiteWriter:
+    """
+    Writer inserting rows into one table, with the same `writerows` interface as `csv.writer`
+
+    :param kept: indices of the fields stored as SQL columns, all of them if None
+    :param extra: names of the fields stored in the json column `EXTRA_COLUMN` by index
+    """
+
+    def __init__(self, handler, table: str, num_cols: int, kept: list = None, extra: dict = None):
+        self.handler = handler
+        self.kept = kept
+        self.extra = extra
+        if kept is not None:
+            num_cols = len(kept) + 1
+        self.insert = f"INSERT INTO {quote_identifier(table)} VALUES ({', '.join(['?'] * num_cols)})"
+
+    def split_row(self, row) -> list:
+        """
+        Values of the kept fields of row followed by the json object of its other filled fields
+        """
+        cells = getattr(row, "cells", None)
+        if cells is None:
+            cells = {index: value for index, value in enumerate(row) if value is not None}
+        values = [cells.get(index) for index in self.kept]
+        extra = {self.extra[index]: value for index, value in cells.items() if index in self.extra}
+        values.append(json.dumps(extra) if extra else None)
+        return values
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        """
+        Insert rows in a single transaction
+        """
+        with self.handler.lock:
+            with self.handler.connection:
+                if self.kept is None:
+                    self.handler.connection.executemany(self.insert, (list(row) for row in rows))
+                else:
+                    self.handler.connection.executemany(self.insert, (self.split_row(row) for row in rows))
+
+
+class SQLiteHandler:
+    """
+    SQLite database holding one typed table per table in mappings, used in place of `FileHandler`
+
+    Tables are dropped and created again with column types inferred from the statistics in mappings.
+    Tables with more columns than SQLite allows keep their most filled columns, see `split_columns`.
+    """
+
+    def __init__(self, db_path, mappings: dict):
+        import sqlite3
+
+        self.connection = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.lock = threading.Lock()  # writes from the flatten thread pool share one connection
+        self.files = {}
+
+        self.journal_mode = self.connection.execute("PRAGMA journal_mode").fetchone()[0]
+        for pragma in SQLITE_PRAGMAS:
+            self.connection.execute(pragma)
+
+        if hasattr(self.connection, "getlimit"):  # python 3.11+
+            max_columns = self.connection.getlimit(sqlite3.SQLITE_LIMIT_COLUMN)
+        else:
+            max_columns = DEFAULT_MAX_COLUMNS
+        self.split_tables = []  # tables with columns stored in `EXTRA_COLUMN`
+
+        with self.connection:
+            for table, sql_table in zip(mappings, unique_names(list(mappings))):
+                items = list(mappings[table].items())
+                kept, extra = split_columns(mappings[table], max_columns)
+                names = [items[i][0] for i in kept] + ([EXTRA_COLUMN] if extra else [])
+                types = [sql_type(items[i][1]) for i in kept] + (["TEXT"] if extra else [])
+                definitions = [f"{quote_identifier(name)} {sql_type_}"
+                               for name, sql_type_ in zip(unique_names(names), types)]
+                if extra:
+                    writer = SQLiteWriter(self, sql_table, len(items), kept, {i: items[i][0] for i in extra})
+                    self.split_tables.append(table)
+                else:
+                    writer = SQLiteWriter(self, sql_table, len(items))
+                self.connection.execute(f"DROP TABLE IF EXISTS {quote_identifier(sql_table)}")
+                self.connection.execute(f"CREATE TABLE {quote_identifier(sql_table)} ({', '.join(definitions)})")
+                self.files[table] = {'name': f"{db_path}:{sql_table}", 'writer': writer}
+
+    def writers(self) -> list:
+        """
+        Get the writers of every table, in the order of mappings
+        """
+        return [self.files[table]['writer'] for table in self.files]
+
+    def close(self):
+        # the journal mode is kept in the database file, restore the mode it had before the load
+        if self.journal_mode.lower() != "wal":
+            self.connection.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+        self.connection.close()
+
+    def flush(self):
+        pass
+
+    def size(self):
+        return len(self.files)
+
+
+class AsyncSink(abc.ABC):
+    """
+    Interface of asynchronous destinations for the rows produced by `json2tab.aflatten`, used by `json2tab.aconvert`
+    """
+
+    async def open(self, mappings: dict):
+        """
+        Prepare the destination of every table in mappings, eg. write the headers
+        """
+
+    @abc.abstractmethod
+    async def write_rows(self, table: str, rows: list):
+        """
+        Write a batch of rows of table, in the column order of mappings
+        """
+
+    async def close(self):
+        """
+        Flush and release the destination
+        """
+
+
+class AsyncCSVSink(AsyncSink):
+    """
+    Async sink writing one CSV file per table, named like the output of `convert`: `<filename>_<table><extension>`
+
+    Files are written in a worker thread so the event loop is not blocked by disk writes.
+    Writes to the files are serialized, as `aconvert` awaits each batch before the next.
+
+    :param out_dir: output directory
+    :param filename: prefix of the output file names
+    :param extension: ".csv" or ".csv.gz"
+    :param write_header: write the column names of mappings as the first row
+    """
+
+    def __init__(self, out_dir, filename: str, extension: str = ".csv", write_header: bool = True):
+        self.out_dir = Path(out_dir)
+        self.filename = filename
+        self.extension = extension
+        self.write_header = write_header
+        self.files = FileHandler()
+        self.writers = {}
+
+    def _open(self, mappings: dict):
+        for table in mappings:
+            f = self.files.open(table, self.out_dir / f"{self.filename}_{table}{self.extension}", mode="wt",
+                                encoding="utf-8", newline="")
+            self.writers[table] = CSVEncoder(f, list(mappings[table].keys()))
+            if self.write_header:
+                self.writers[table].writeheader()
+
+    async def open(self, mappings: dict):
+        await asyncio.get_running_loop().run_in_executor(None, self._open, mappings)
+
+    async def write_rows(self, table: str, rows: list):
+        await asyncio.get_running_loop().run_in_executor(None, self.writers[table].writerows, rows)
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.files.close)
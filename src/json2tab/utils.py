@@ -1,6 +1,44 @@
-import ijson
+import glob
+import io
+import os
+
 from json2tab.helpers import Stack, open_file
 
+PROBE_SIZE = 1024 * 1024  # bytes read from the start of a file to probe it
+
+_probes = {}  # probe results by file path, size and modification time
+
+
+def coroutine(func):
+    """
+    Decorator priming a generator based coroutine, like `ijson.coroutine` without importing ijson
+    """
+
+    def start(*args, **kwargs):
+        coro = func(*args, **kwargs)
+        next(coro)
+        return coro
+
+    return start
+
+
+def get_input_files(filepath: str) -> list:
+    """
+    Expand an input path into the list of json files it refers to
+
+    A directory gives every .json and .json.gz file in it, a glob pattern gives every matching file,
+    anything else is returned as is.
+
+    :param filepath: file path, directory or glob pattern
+    :return: sorted list of file paths
+    """
+    if os.path.isdir(filepath):
+        return sorted(str(p) for p in glob.glob(os.path.join(filepath, "*"))
+                      if p.endswith(".json") or p.endswith(".json.gz"))
+    if glob.has_magic(filepath):
+        return sorted(p for p in glob.glob(filepath) if os.path.isfile(p))
+    return [filepath]
+
 
 def get_top_keys(json_file: str) -> list:
     """
@@ -9,19 +47,72 @@ def get_top_keys(json_file: str) -> list:
     :param json_file: json file path
     :return: list of top-level keys from first json line
     """
-    result = []
-    with open_file(json_file, mode="rb") as f:
-        for (_, prefix, event, value) in parse(f, multiple_values=True):
-            if prefix == '' and event == 'map_key' and value:
-                result.append(value)
-            elif prefix == '' and event == 'end_map' and value is None:
-                f.seek(0)  # read from beginning again
-                break
+    return list(probe_file(json_file)["top_keys"])
 
+
+def read_top_keys(f) -> list:
+    """
+    Get the top-level keys of the first json in a binary file-like object
+    """
+    result = []
+    for (_, prefix, event, value) in parse(f, multiple_values=True):
+        if prefix == '' and event == 'map_key' and value:
+            result.append(value)
+        elif prefix == '' and event == 'end_map' and value is None:
+            break
     return result
 
 
-@ijson.coroutine
+def probe_file(json_file: str) -> dict:
+    """
+    Read the start of json_file once to get its top-level keys, compression, size and an estimate of its
+    number of records (assuming one json per line)
+
+    Results are cached for the rest of the run, until the file changes.
+
+    :param json_file: json file path
+    :return: dict with keys "path", "compression", "size", "top_keys", "estimated_records"
+    """
+    from ijson import IncompleteJSONError
+
+    stat = os.stat(json_file)
+    cache_key = (os.path.abspath(json_file), stat.st_size, stat.st_mtime_ns)
+    if cache_key in _probes:
+        return _probes[cache_key]
+
+    compressed = json_file.endswith(".gz")
+    with open_file(json_file, mode="rb") as f:
+        sample = f.read(PROBE_SIZE)
+        # bytes of the file read for the sample, compressed bytes for gzip
+        consumed = f.fileobj.tell() if compressed else len(sample)
+
+    try:
+        top_keys = read_top_keys(io.BytesIO(sample))
+    except IncompleteJSONError:
+        # first json is larger than the sample
+        with open_file(json_file, mode="rb") as f:
+            top_keys = read_top_keys(f)
+
+    lines = sample.count(b"\n")
+    if len(sample) < PROBE_SIZE:
+        estimated_records = lines + (1 if sample.strip() and not sample.endswith(b"\n") else 0)
+    elif lines:
+        estimated_records = round(stat.st_size * lines / max(consumed, 1))
+    else:
+        estimated_records = None  # not one json per line
+
+    probe = {
+        "path": json_file,
+        "compression": "gzip" if compressed else "none",
+        "size": stat.st_size,
+        "top_keys": top_keys,
+        "estimated_records": estimated_records,
+    }
+    _probes[cache_key] = probe
+    return probe
+
+
+@coroutine
 def parse_coro(target):
     """
     Generator based on `ijson.parse` function
@@ -132,6 +223,8 @@ def parse(file, **kwargs):
     The base prefix for this would be `a`
     """
 
+    import ijson
+
     basic_events = ijson.basic_parse(file, **kwargs)
     path = []
 
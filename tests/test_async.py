@@ -0,0 +1,78 @@
+import asyncio
+import io
+import json
+
+from json2tab import AsyncCSVSink, Config, Mapping, aconvert, aflatten, convert_file
+
+
+class AsyncReader:
+    """
+    Async file-like object over bytes, read in small chunks
+    """
+
+    def __init__(self, data: bytes):
+        self.f = io.BytesIO(data)
+
+    async def read(self, size: int) -> bytes:
+        await asyncio.sleep(0)
+        return self.f.read(min(size, 37))
+
+
+async def async_chunks(data: bytes):
+    for start in range(0, len(data), 53):
+        await asyncio.sleep(0)
+        yield data[start:start + 53]
+
+
+def write_input(path):
+    with open(path, "w") as f:
+        for i in range(40):
+            record = {"factId": i, "site": {"name": f"site {i}", "tags": ["a", "b,c"][:i % 3], "size": i * 1.5},
+                      "owner": {"name": f"owner {i % 4}", "emails": [f"{i}@x.org"] * (i % 2)}}
+            f.write(json.dumps(record) + "\n")
+
+
+def test_aconvert_matches_convert(tmp_path):
+    json_file = tmp_path / "in.json"
+    write_input(json_file)
+    config = Config(str(json_file), str(tmp_path), 7)
+    config.identifiers = ["factId"]
+    config.progress = "none"
+    mappings = Mapping.create_mappings(["site", "owner"], config)
+
+    out_dir = tmp_path / "sync"
+    out_dir.mkdir()
+    convert_file(str(json_file), str(out_dir), "in", ["site", "owner"], mappings, config)
+
+    data = json_file.read_bytes()
+    for name, source in (("reader", AsyncReader(data)), ("iterable", async_chunks(data))):
+        async_dir = tmp_path / name
+        async_dir.mkdir()
+        num_rows = asyncio.run(aconvert(source, AsyncCSVSink(async_dir, "in"), mappings, identifiers=["factId"],
+                                        chunk_size=7))
+        assert num_rows == 80
+        for table in ("site", "owner"):
+            assert (async_dir / f"in_{table}.csv").read_bytes() == (out_dir / f"in_{table}.csv").read_bytes()
+
+
+def test_aflatten_sources_give_the_same_rows(tmp_path):
+    json_file = tmp_path / "in.json"
+    write_input(json_file)
+    config = Config(str(json_file), str(tmp_path), 7)
+    config.identifiers = ["factId"]
+    config.progress = "none"
+    mappings = Mapping.create_mappings(["site", "owner"], config)
+    data = json_file.read_bytes()
+
+    async def collect(source):
+        rows = {}
+        async for table, batch in aflatten(source, mappings, ["site"], identifiers=["factId"], chunk_size=5):
+            rows.setdefault(table, []).extend(batch)
+        return rows
+
+    from_reader = asyncio.run(collect(AsyncReader(data)))
+    from_iterable = asyncio.run(collect(async_chunks(data)))
+    assert from_reader == from_iterable
+    assert list(from_reader) == ["site"]
+    assert [row[0] for row in from_reader["site"]] == list(range(40))
+    assert len(from_reader["site"][0]) == len(mappings["site"])
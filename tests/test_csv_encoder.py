@@ -0,0 +1,90 @@
+import csv
+import io
+import json
+import random
+
+from json2tab import Config, Mapping, convert_file
+from json2tab.helpers import CSVEncoder, SparseRow
+
+VALUES = ["a", "b c", "", "x,y", 'say "hi"', "line\nbreak", "cr\rreturn", " padded ", 0, 1.5, -3, True, False]
+
+
+def csv_module_output(rows) -> str:
+    out = io.StringIO(newline='')
+    csv.writer(out).writerows([list(row) for row in rows])
+    return out.getvalue()
+
+
+def encoder_output(rows) -> str:
+    out = io.StringIO(newline='')
+    CSVEncoder(out).writerows(rows)
+    return out.getvalue()
+
+
+def test_sparse_rows():
+    rows = [SparseRow(50, {0: 1, 17: "a", 49: 2.5}), SparseRow(50, {}), SparseRow(50, {49: "last"}),
+            SparseRow(50, {0: "first"})]
+    assert encoder_output(rows) == csv_module_output(rows)
+
+
+def test_dense_rows():
+    rows = [SparseRow(4, {0: 1, 1: "a", 2: True, 3: 0.5}), [1, None, "b", False], ["x"] * 10]
+    assert encoder_output(rows) == csv_module_output(rows)
+
+
+def test_values_needing_quotes():
+    rows = [SparseRow(30, {3: value, 20: "plain"}) for value in VALUES] + [[value, None] for value in VALUES]
+    assert encoder_output(rows) == csv_module_output(rows)
+
+
+def test_empty_strings():
+    rows = [SparseRow(1, {0: ""}), SparseRow(20, {5: ""}), SparseRow(20, {0: "", 19: ""}), [""], ["", ""]]
+    assert encoder_output(rows) == csv_module_output(rows)
+
+
+def test_single_column_rows():
+    rows = [SparseRow(1, {}), SparseRow(1, {0: "a"}), SparseRow(1, {0: 1}), SparseRow(1, {0: "x,y"}), [None], ["a"]]
+    assert encoder_output(rows) == csv_module_output(rows)
+
+
+def test_random_rows():
+    rng = random.Random(0)
+    rows = []
+    for _ in range(2000):
+        size = rng.choice([1, 2, 5, 40, 300])
+        fill = rng.choice([0.0, 0.01, 0.1, 0.9])
+        rows.append(SparseRow(size, {i: rng.choice(VALUES) for i in range(size) if rng.random() < fill}))
+    assert encoder_output(rows) == csv_module_output(rows)
+
+
+def test_csv_module_parity(tmp_path):
+    json_file = tmp_path / "in.json"
+    with open(json_file, "w") as f:
+        for i in range(50):
+            record = {"factId": i, "site": {"name": VALUES[i % len(VALUES)], "tags": VALUES[:i % 7],
+                                            f"rare{i % 25}": i}}
+            f.write(json.dumps(record) + "\n")
+
+    outputs = {}
+    for csv_module in (False, True):
+        out_dir = tmp_path / f"out_{csv_module}"
+        out_dir.mkdir()
+        config = Config(str(json_file), str(out_dir), 7)
+        config.identifiers = ["factId"]
+        config.csv_module = csv_module
+        config.progress = "none"
+        mappings = Mapping.create_mappings(["site"], config)
+        convert_file(str(json_file), str(out_dir), "in", ["site"], mappings, config)
+        outputs[csv_module] = (out_dir / "in_site.csv").read_bytes()
+
+    assert outputs[False] == outputs[True]
+    assert outputs[False].count(b"\r\n") > 50
+
+
+def test_header():
+    header = ["factId", "site.name", "site.a,b", 'site."q"']
+    out = io.StringIO(newline='')
+    encoder = CSVEncoder(out, header)
+    encoder.writeheader()
+    encoder.writerows([SparseRow(4, {0: 1}), ["x", None, "y", "z"]])
+    assert out.getvalue() == csv_module_output([header, SparseRow(4, {0: 1}), ["x", None, "y", "z"]])
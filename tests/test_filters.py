@@ -0,0 +1,57 @@
+import pytest
+
+from json2tab.filters import Condition, RecordFilter
+
+
+@pytest.mark.parametrize("expression, value, expected", [
+    ("factId == 3", 3, True),
+    ("factId == 3.0", 3, True),
+    ("factId == 3", 3.5, False),
+    ("factId in [1, 2, 3.0]", 3, True),
+    ("factId not in [1, 2, 3.0]", 3, False),
+    ("rollNumber == 123", "123", True),
+    ("rollNumber in [123]", "123", True),
+    ('site.status == "active"', "active", True),
+    ("site.status == active", "active", True),
+    ("site.status != active", "closed", True),
+    ("site.flag == true", True, True),
+    ("site.flag == true", "True", False),
+    ("site.area == 2.5", 2.5, True),
+    ("site.status == null", None, True),
+    ("site.status == null", "null", False),
+    ("site.status != null", None, False),
+    ("site.status == active", None, False),
+    ("site.status != active", None, True),
+    ("site.status in [\"active\"]", None, False),
+    ("site.status not in [\"active\"]", None, True),
+])
+def test_condition(expression, value, expected):
+    assert Condition(expression).test(value) is expected
+
+
+def test_condition_file_operand(tmp_path):
+    values = tmp_path / "rolls.txt"
+    values.write_text("001\n2.0\n\nabc\n")
+    condition = Condition(f"rollNumber in {values}")
+    assert condition.test("001")
+    assert condition.test(2)
+    assert condition.test("abc")
+    assert not condition.test(1)
+
+
+def test_invalid_expression():
+    with pytest.raises(ValueError):
+        Condition("site.status ~ active")
+
+
+def test_record_filter_missing_leaf():
+    record_filter = RecordFilter(["site.status == active", "factId != 3"])
+    assert record_filter.test("site.status", "active")
+    assert record_filter.end_record()
+
+    # missing site.status
+    assert record_filter.test("factId", 4)
+    assert not record_filter.end_record()
+
+    assert not record_filter.test("factId", 3)
+    record_filter.end_record()
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from json2tab import mapfile
+
+MAPPINGS = {
+    "site": {
+        "factId": {"types": ["integer"], "count": 3, "nulls": 0, "max_length": 0},
+        "site.status": {"types": ["string"], "count": 3, "nulls": 0, "max_length": 6},
+        "site.tags.0": {"types": ["string", "integer"], "count": 2, "nulls": 1, "max_length": 1},
+        "site.näme": {"types": [], "count": 0, "nulls": 3, "max_length": 0},
+        "site.a\u0000b": {"types": ["boolean"], "count": 1, "nulls": 2, "max_length": 0},
+        "_overflow": None,
+    },
+    "owner": {
+        "factId": {"types": ["integer"], "count": 3, "nulls": 0, "max_length": 0},
+        "owner.name": None,
+    },
+    "empty": {},
+}
+
+
+def test_json_binary_json_round_trip(tmp_path):
+    json_path = tmp_path / "in_mappings.json"
+    binary_path = tmp_path / f"in_mappings{mapfile.EXTENSION}"
+    out_path = tmp_path / "out_mappings.json"
+    with open(json_path, "w") as f:
+        json.dump(MAPPINGS, f)
+
+    mapfile.save_mappings(mapfile.load_mappings(json_path), binary_path)
+    mapfile.save_mappings(mapfile.load_mappings(binary_path), out_path)
+
+    with open(out_path) as f:
+        result = json.load(f)
+    assert result == MAPPINGS
+    assert list(result) == list(MAPPINGS)
+    assert all(list(result[table]) == list(MAPPINGS[table]) for table in MAPPINGS)
+
+
+def test_selected_tables_are_decoded_lazily(tmp_path):
+    path = tmp_path / f"m{mapfile.EXTENSION}"
+    mapfile.write_mappings(MAPPINGS, path)
+
+    assert mapfile.read_table_names(path) == ["site", "owner", "empty"]
+    with mapfile.MappingFile(path) as mapping_file:
+        assert mapping_file.columns("owner") == ["factId", "owner.name"]
+        assert mapping_file["owner"] == MAPPINGS["owner"]
+        assert list(mapping_file.tables) == ["owner"]
+        # only the strings of the table are decoded: its column names and the types of factId
+        assert sorted(mapping_file.strings.values()) == ["factId", "integer", "owner.name"]
+
+    assert mapfile.load_mappings(path, ["owner", "empty"]) == {"owner": MAPPINGS["owner"], "empty": {}}
+
+
+def test_invalid_files_raise_value_error(tmp_path):
+    path = tmp_path / f"m{mapfile.EXTENSION}"
+    mapfile.write_mappings(MAPPINGS, path)
+    data = path.read_bytes()
+
+    for size in (0, 4, mapfile.HEADER.size + 3, len(data) // 2, len(data) - 1):
+        truncated = tmp_path / f"truncated{size}{mapfile.EXTENSION}"
+        truncated.write_bytes(data[:size])
+        with pytest.raises(ValueError):
+            mapfile.load_mappings(truncated)
+
+    not_binary = tmp_path / f"json{mapfile.EXTENSION}"
+    not_binary.write_text(json.dumps(MAPPINGS))
+    with pytest.raises(ValueError):
+        mapfile.load_mappings(not_binary)
@@ -0,0 +1,28 @@
+import json
+
+import pytest
+
+from json2tab import Config, Mapping
+
+
+@pytest.mark.parametrize("sample_fraction", [0.0, 0.5])
+def test_mapping_progress_follows_the_progress_mode(tmp_path, capsys, sample_fraction):
+    json_file = tmp_path / "in.json"
+    with open(json_file, "w") as f:
+        for i in range(3000):
+            f.write(json.dumps({"factId": i, "site": {"name": f"site {i}", "tags": [i, i + 1]}}) + "\n")
+
+    stages = {}
+    for mode in ("json", "none"):
+        config = Config(str(json_file), str(tmp_path), 7)
+        config.identifiers = ["factId"]
+        config.sample_fraction = sample_fraction
+        config.progress = mode
+        config.progress_interval = 0.0
+        Mapping.create_mappings(["site"], config)
+        lines = capsys.readouterr().err.splitlines()
+        stages[mode] = [json.loads(line)["stage"] for line in lines]
+
+    expected = "Sampling records" if sample_fraction else "Creating mappings"
+    assert stages["json"] and set(stages["json"]) == {expected}
+    assert stages["none"] == []
@@ -0,0 +1,36 @@
+import json
+import sqlite3
+
+from json2tab import Config, Mapping, convert_file
+from json2tab.sinks import unique_names
+
+
+def test_unique_names():
+    assert unique_names(["a.Name", "a.name", "a.NAME"]) == ["a.Name", "a.name_2", "a.NAME_3"]
+    assert unique_names(["a.Name", "a.name", "a.name_2"]) == ["a.Name", "a.name_3", "a.name_2"]
+    assert unique_names(["site", "owner"]) == ["site", "owner"]
+
+
+def test_names_differing_in_case_and_journal_mode(tmp_path):
+    json_file = tmp_path / "in.json"
+    with open(json_file, "w") as f:
+        f.write(json.dumps({"factId": 1, "a": {"Name": "x", "name": "y"}, "A": {"v": 1}}) + "\n")
+        f.write(json.dumps({"factId": 2, "a": {"name": "z"}, "A": {"v": 2}}) + "\n")
+    db_path = tmp_path / "out.db"
+    connection = sqlite3.connect(str(db_path))
+    connection.execute("CREATE TABLE other (x)")
+    connection.close()
+
+    config = Config(str(json_file), str(tmp_path), 7)
+    config.identifiers = ["factId"]
+    config.sqlite_file = str(db_path)
+    config.progress = "none"
+    mappings = Mapping.create_mappings(["a", "A"], config)
+    convert_file(str(json_file), str(tmp_path), "in", list(mappings), mappings, config)
+
+    connection = sqlite3.connect(str(db_path))
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    assert connection.execute('SELECT "factId", "a.Name", "a.name_2" FROM "a"').fetchall() == \
+        [(1, "x", "y"), (2, None, "z")]
+    assert connection.execute('SELECT "factId", "A.v" FROM "A_2"').fetchall() == [(1, 1), (2, 2)]
+    connection.close()
@@ -0,0 +1,80 @@
+import csv
+import json
+
+import pytest
+
+from json2tab import Config, Mapping, convert_file
+from json2tab.helpers import open_file
+
+
+def write_records(path, records):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def run(tmp_path, name, records, where=()):
+    json_file = tmp_path / f"{name}.json"
+    write_records(json_file, records)
+    out_dir = tmp_path / name
+    out_dir.mkdir()
+
+    config = Config(str(json_file), str(out_dir), 10)
+    config.identifiers = ["factId"]
+    config.state_file = str(tmp_path / "state.gz")
+    config.where = where
+    config.progress = "none"
+    mappings = Mapping.create_mappings(["site"], config)
+    convert_file(str(json_file), str(out_dir), name, ["site"], mappings, config)
+
+    with open(out_dir / f"{name}_site.csv", newline="") as f:
+        rows = list(csv.reader(f))[1:]
+    with open_file(str(out_dir / f"{name}_deletions.csv"), mode="rt", newline="") as f:
+        deletions = list(csv.reader(f))[1:]
+    return rows, deletions
+
+
+def records(count):
+    return [{"factId": i, "site": {"status": "active" if i % 2 else "closed", "area": i * 1.5}} for i in range(count)]
+
+
+def test_only_changed_records_are_written(tmp_path):
+    rows, deletions = run(tmp_path, "day1", records(20))
+    assert len(rows) == 20 and deletions == []
+
+    day2 = records(20)[1:]
+    day2[4]["site"]["area"] = -1
+    rows, deletions = run(tmp_path, "day2", day2)
+    assert [row[0] for row in rows] == ["5"]
+    assert deletions == [["0"]]
+
+
+def test_new_columns_do_not_change_hashes(tmp_path):
+    run(tmp_path, "day1", records(20))
+
+    day2 = records(20) + [{"factId": 100, "site": {"status": "active", "new_leaf": "x"}}]
+    rows, deletions = run(tmp_path, "day2", day2)
+    assert [row[0] for row in rows] == ["100"]
+    assert deletions == []
+
+
+def test_where_keeps_state_of_skipped_records(tmp_path):
+    run(tmp_path, "day1", records(20))
+
+    day2 = records(20)
+    day2[3]["site"]["area"] = -1
+    day2[4]["site"]["area"] = -1
+    rows, deletions = run(tmp_path, "day2", day2, where=["factId == 3"])
+    assert [row[0] for row in rows] == ["3"]
+    assert deletions == []
+
+    # the skipped change of record 4 is still found by the next run
+    rows, deletions = run(tmp_path, "day3", day2)
+    assert [row[0] for row in rows] == ["4"]
+    assert deletions == []
+
+
+def test_duplicate_identifiers_are_rejected(tmp_path):
+    with pytest.raises(Exception, match="identifier values"):
+        run(tmp_path, "day1", records(5) + records(1))
+    assert not (tmp_path / "state.gz").exists()